@@ -0,0 +1,1182 @@
+"""
+Microbenchmarks for PyOTP internals.
+
+Usage: python benchmark.py [name ...]
+Run every benchmark if no name is given.
+"""
+from panda3d.core import Datagram, DatagramIterator, Filename
+from panda3d.direct import DCFile, DCPacker
+from message_director import MessageDirector, MDClient, RangeIndex
+from client import Client
+from distributed_object import DistributedObject
+from snapshot import SnapshotWriter, restoreSnapshot
+from py_otp import PyOTP
+from msgtypes import *
+
+import collections
+import multiprocessing
+import os
+import random
+import selectors
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+
+def measure(function, number=1):
+    """
+    Return the time (in seconds) of a single call
+    """
+    start = time.perf_counter()
+    for _ in range(number):
+        function()
+
+    return (time.perf_counter() - start) / number
+
+
+def makeStateServer():
+    """
+    A StateServer with a ClientAgent (without clients) and a MessageDirector (without MD clients),
+    not listening. Timers are never run, unless a benchmark runs the loop.
+    """
+    return PyOTP(listen=False)
+
+
+def generateMessage(dclass, doId, parentId, zoneId):
+    """
+    STATESERVER_OBJECT_GENERATE_WITH_REQUIRED with default required fields
+    """
+    packer = DCPacker()
+    for index in range(dclass.getNumInheritedFields()):
+        field = dclass.getInheritedField(index)
+        if field.isRequired() and field.asAtomicField():
+            packer.beginPack(field)
+            packer.packDefaultValue()
+            packer.endPack()
+
+    dg = Datagram()
+    dg.addUint32(parentId)
+    dg.addUint32(zoneId)
+    dg.addUint16(dclass.getNumber())
+    dg.addUint32(doId)
+    dg.appendData(packer.getBytes())
+    return dg
+
+
+def generate(otp, doId, dclassName, parentId, zoneId, sender=4000000):
+    """
+    Generate an object, like an AI does
+    """
+    dg = generateMessage(otp.dc.getClassByName(dclassName), doId, parentId, zoneId)
+    otp.stateServer.handle(20100000, sender, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, dg)
+    return otp.stateServer.objects[doId]
+
+
+def addClient(otp, parentId, zones):
+    """
+    Add a game client interested in these zones
+    """
+    client = Client(otp.clientAgent)
+    client.connection_made(BenchTransport())
+    client.interests[1] = (parentId, set(zones))
+    client.updateInterestCache()
+    return client
+
+
+class AllocationProbe:
+    """
+    Count the memory blocks allocated since start() that are still
+    allocated when a message reaches a destination (handler or transport).
+    Counting is slow, so it's only done while the probe is active.
+    """
+    def __init__(self):
+        self.active = False
+        self.base = 0
+        self.blocks = 0
+
+    def start(self):
+        self.base = sys.getallocatedblocks()
+        self.blocks = 0
+
+    def __call__(self):
+        if self.active:
+            self.blocks = max(self.blocks, sys.getallocatedblocks() - self.base)
+
+
+class BenchTransport:
+    """
+    Transport dropping everything
+    """
+    def __init__(self, probe=None):
+        self.written = 0
+        self.writes = 0
+        self.probe = probe
+
+    def write(self, data):
+        self.written += len(data)
+        self.writes += 1
+        if self.probe:
+            self.probe()
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    def is_closing(self):
+        return False
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+
+class BenchHandler:
+    """
+    Local handler reading the doId of the message, like the StateServer does
+    """
+    def __init__(self, probe=None):
+        self.probe = probe
+
+    def handle(self, channel, sender, code, datagram):
+        DatagramIterator(datagram).getUint32()
+        if self.probe:
+            self.probe()
+
+
+def benchRanges():
+    """
+    An AI subscribing to a whole doId range, with CONTROL_SET_CHANNEL for
+    every channel versus a single CONTROL_ADD_RANGE.
+    """
+    low = 100000000
+    lookups = [random.randrange(low - 1000, low + 200000) for _ in range(100000)]
+
+    # Other AIs with a few exact channels each
+    others = [object() for _ in range(20)]
+
+    for count in (1000, 10000, 100000):
+        high = low + count - 1
+
+        exact = MessageDirector(None)
+        ranged = MessageDirector(None)
+        for md in (exact, ranged):
+            for n, other in enumerate(others):
+                md.subscribe(other, 4000000 + n)
+
+        client = object()
+
+        def subscribeExact():
+            for channel in range(low, high + 1):
+                exact.subscribe(client, channel)
+
+        def subscribeRange():
+            ranged.ranges.add(client, low, high)
+
+        setupExact = measure(subscribeExact)
+        setupRange = measure(subscribeRange)
+
+        routeExact = measure(lambda: [exact.getSubscribers((channel,)) for channel in lookups]) / len(lookups)
+        routeRange = measure(lambda: [ranged.getSubscribers((channel,)) for channel in lookups]) / len(lookups)
+
+        print("ranges: %6d channels | subscribe: exact %8.2f ms, %6d messages | range %6.3f ms, 1 message" % (count, setupExact * 1e3, count, setupRange * 1e3))
+        print("ranges: %6d channels | route: exact %.3f us/message | range %.3f us/message" % (count, routeExact * 1e6, routeRange * 1e6))
+
+    # Lookup cost with many ranges
+    for count in (10, 1000, 100000):
+        ranges = RangeIndex()
+        for n in range(count):
+            ranges.add(n % 50, n * 100, n * 100 + 49)
+
+        channels = [random.randrange(0, count * 100) for _ in range(100000)]
+        lookup = measure(lambda: [ranges.lookup(channel) for channel in channels]) / len(channels)
+        print("ranges: %6d ranges | lookup %.3f us" % (count, lookup * 1e6))
+
+
+def measureAllocations(function, probe, number=1000):
+    """
+    Memory allocated to handle a message: blocks still allocated when it reaches
+    its destinations (see AllocationProbe), and peak of traced memory (in bytes)
+    """
+    blocks = 0
+    peak = 0
+
+    function()
+    probe.active = True
+    tracemalloc.start()
+    for _ in range(number):
+        probe.start()
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        function()
+        blocks += probe.blocks
+        peak += tracemalloc.get_traced_memory()[1] - start
+
+    tracemalloc.stop()
+    probe.active = False
+    return blocks / number, peak / number
+
+
+def benchMessages():
+    """
+    Routing of an update through MDClient.onDatagram and MessageDirector.sendMessage,
+    to local handlers and remote MD clients: time, and memory allocated per message.
+    """
+    count = 20000
+    channel = 100000000
+
+    payload = Datagram()
+    payload.addUint32(channel)
+    payload.addUint16(0)
+    payload.appendData(b"\0" * 32)
+
+    frame = struct.pack("<BQQH", 1, channel, 1000, 2004) + bytes(payload)
+    view = memoryview(frame)
+
+    for locals_, remotes in ((1, 0), (0, 3), (1, 3), (2, 10)):
+        otp = PyOTP(mdOnly=True, listen=False)
+        md = otp.messageDirector
+        sender = MDClient(md)
+        sender.transport = BenchTransport()
+        probe = AllocationProbe()
+
+        for _ in range(locals_):
+            otp.registerChannel(channel, BenchHandler(probe))
+
+        for _ in range(remotes):
+            client = MDClient(md)
+            client.transport = BenchTransport(probe)
+            md.subscribe(client, channel)
+
+        received = min(measure(lambda: [sender.onDatagram(view) for _ in range(count)]) for _ in range(5)) / count
+        sent = min(measure(lambda: [md.sendMessage([channel], 1000, 2004, payload) for _ in range(count)]) for _ in range(5)) / count
+
+        print("messages: %d local, %2d remote | received %.2f us/message | sent %.2f us/message" % (locals_, remotes, received * 1e6, sent * 1e6))
+
+        receivedBlocks, receivedPeak = measureAllocations(lambda: sender.onDatagram(view), probe)
+        sentBlocks, sentPeak = measureAllocations(lambda: md.sendMessage([channel], 1000, 2004, payload), probe)
+
+        print("messages: %d local, %2d remote | received %.1f blocks, %.0f bytes peak | sent %.1f blocks, %.0f bytes peak" % (
+            locals_, remotes, receivedBlocks, receivedPeak, sentBlocks, sentPeak))
+
+
+def startMessageDirector(port, upstream=None, args=("--md-only",)):
+    """
+    Start a PyOTP process (MD only by default), and wait until its MD is listening
+    """
+    args = [sys.executable, "py_otp.py", "--md-port", str(port)] + list(args)
+    if upstream:
+        args += ["--upstream", "127.0.0.1:%d" % upstream]
+
+    process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return process
+
+        except OSError:
+            if process.poll() is not None:
+                raise Exception("MD failed to start on port %d" % port)
+
+            time.sleep(0.1)
+
+
+def floodPair(port, channel, count, results):
+    """
+    An AI sending count messages to another AI, through the MD listening on port
+    """
+    receiver = socket.create_connection(("127.0.0.1", port))
+    sender = socket.create_connection(("127.0.0.1", port))
+
+    control = struct.pack("<BQHQ", 1, CONTROL_MESSAGE, CONTROL_SET_CHANNEL, channel)
+    receiver.sendall(struct.pack("<H", len(control)) + control)
+    time.sleep(1)
+
+    frame = struct.pack("<BQQH", 1, channel, 1000, STATESERVER_OBJECT_UPDATE_FIELD) + b"\0" * 32
+    batch = (struct.pack("<H", len(frame)) + frame) * 100
+    size = (len(frame) + 2) * count
+
+    start = time.perf_counter()
+    for _ in range(count // 100):
+        sender.sendall(batch)
+
+        # We don't want to fill the MD buffers, so we're reading as we go
+        receiver.setblocking(False)
+        try:
+            while True:
+                data = receiver.recv(1 << 20)
+                size -= len(data)
+
+        except BlockingIOError:
+            pass
+
+        receiver.setblocking(True)
+
+    while size > 0:
+        size -= len(receiver.recv(1 << 20))
+
+    results.put(time.perf_counter() - start)
+
+
+def benchFederation():
+    """
+    AIs flooding each other through one MD, versus the same AIs spread over
+    several MDs connected to a root MD (every message also goes up to the root).
+    """
+    pairs = 4
+    count = 50000
+
+    for nodes in (0, 2, 4):
+        processes = [startMessageDirector(7100)]
+        for n in range(nodes):
+            processes.append(startMessageDirector(7101 + n, 7100))
+
+        # AIs are on the leaf MDs, or on the only one
+        ports = [7101 + n for n in range(nodes)] or [7100]
+
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=floodPair, args=(ports[n % len(ports)], 500000000 + n, count, results)) for n in range(pairs)]
+        for worker in workers:
+            worker.start()
+
+        elapsed = max(results.get() for _ in workers)
+        for worker in workers:
+            worker.join()
+
+        for process in processes:
+            process.kill()
+            process.wait()
+
+        print("federation: %d AI pairs, %s | %.0f messages/s" % (pairs, "1 MD" if not nodes else "%d MDs + root" % nodes, pairs * count / elapsed))
+
+
+def flood(port, channel, count, readers=10):
+    """
+    An AI sending count messages as fast as it can, to several readers
+    """
+    control = struct.pack("<BQHQ", 1, CONTROL_MESSAGE, CONTROL_SET_CHANNEL, channel)
+    receivers = []
+    for _ in range(readers):
+        receiver = socket.create_connection(("127.0.0.1", port))
+        receiver.sendall(struct.pack("<H", len(control)) + control)
+        receivers.append(receiver)
+
+    sender = socket.create_connection(("127.0.0.1", port))
+    frame = struct.pack("<BQQH", 1, channel, 1000, STATESERVER_OBJECT_UPDATE_FIELD) + b"\0" * 64
+    batch = (struct.pack("<H", len(frame)) + frame) * 1000
+    time.sleep(0.5)
+
+    # We're reading in a thread, so the MD is never blocked by us
+    size = (len(frame) + 2) * count * readers
+    def read():
+        nonlocal size
+        selector = selectors.DefaultSelector()
+        for receiver in receivers:
+            selector.register(receiver, selectors.EVENT_READ)
+
+        while size > 0:
+            for key, mask in selector.select():
+                size -= len(key.fileobj.recv(1 << 20))
+
+    thread = threading.Thread(target=read)
+    thread.start()
+
+    for _ in range(count // 1000):
+        sender.sendall(batch)
+
+    thread.join()
+
+
+def floodControl(port, count):
+    """
+    An AI sending count CONTROL messages as fast as it can
+    """
+    sender = socket.create_connection(("127.0.0.1", port))
+    frame = struct.pack("<BQH", 1, CONTROL_MESSAGE, CONTROL_SET_CON_NAME) + struct.pack("<H", 64) + b"a" * 64
+    batch = (struct.pack("<H", len(frame)) + frame) * 1000
+
+    for _ in range(count // 1000):
+        sender.sendall(batch)
+
+    # We wait for the MD to read everything
+    sender.shutdown(socket.SHUT_WR)
+    sender.recv(1)
+
+
+def benchFairness():
+    """
+    Latency of a well-behaved AI (one message every 5 ms) while another AI
+    is flooding the MD with a burst of updates, or of CONTROL messages.
+    """
+    port = 7200
+    process = startMessageDirector(port)
+
+    receiver = socket.create_connection(("127.0.0.1", port))
+    control = struct.pack("<BQHQ", 1, CONTROL_MESSAGE, CONTROL_SET_CHANNEL, 600000000)
+    receiver.sendall(struct.pack("<H", len(control)) + control)
+    sender = socket.create_connection(("127.0.0.1", port))
+    time.sleep(0.5)
+
+    frame = struct.pack("<BQQH", 1, 600000000, 1000, STATESERVER_OBJECT_UPDATE_FIELD) + b"\0" * 16
+    probe = struct.pack("<H", len(frame)) + frame
+
+    workers = {
+        "idle    ": None,
+        "flooding": (flood, (port, 600000001, 100000)),
+        "control ": (floodControl, (port, 400000)),
+    }
+
+    for name, worker in workers.items():
+        if worker:
+            worker = multiprocessing.Process(target=worker[0], args=worker[1])
+            worker.start()
+            time.sleep(1)
+
+        latencies = []
+        for _ in range(200):
+            start = time.perf_counter()
+            sender.sendall(probe)
+
+            data = b""
+            while len(data) < len(probe):
+                data += receiver.recv(len(probe) - len(data))
+
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.005)
+
+        if worker:
+            worker.join()
+
+        latencies.sort()
+        print("fairness: %s | probe latency p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (name, latencies[100] * 1e3, latencies[198] * 1e3, latencies[-1] * 1e3))
+
+    process.kill()
+    process.wait()
+
+
+def benchShardRest():
+    """
+    STATESERVER_SHARD_REST of one of 10 shards with 10k objects each,
+    with 1000 game clients interested in the zones of the shard going down.
+    """
+    otp = makeStateServer()
+    ss = otp.stateServer
+    dclass = otp.dc.getClassByName("DistributedSmoothNode")
+    district = otp.dc.getClassByName("DistributedDistrict")
+
+    for shard in range(10):
+        shardId = 4000000 + shard
+        districtId = 200000000 + shard * 100000
+
+        do = DistributedObject(districtId, district, 0, 0)
+        do.senderId = shardId
+        ss.addObject(do)
+
+        for n in range(1, 10000):
+            do = DistributedObject(districtId + n, dclass, districtId, 2000 + n % 100)
+            do.senderId = shardId
+            ss.addObject(do)
+
+    for n in range(1000):
+        addClient(otp, 200000000, (2000 + n % 100,))
+
+    dg = Datagram()
+    dg.addUint64(4000000)
+    elapsed = measure(lambda: ss.handle(20100000, 4000000, STATESERVER_SHARD_REST, dg))
+    written = sum(client.transport.written for client in otp.clientAgent.clients)
+    print("shardrest: 10k of %d objects, 1000 clients | %.0f ms, %d bytes to clients" % (len(ss.objects) + 10000, elapsed * 1e3, written))
+
+
+def benchInterest():
+    """
+    A client opening interest on a crowded playground (toons and suits)
+    """
+    otp = makeStateServer()
+    generate(otp, 200000000, "DistributedDistrict", 0, 0)
+    for n in range(200):
+        generate(otp, 300000000 + n, "DistributedToon", 200000000, 2000)
+        generate(otp, 310000000 + n, "DistributedSuit", 200000000, 2000)
+
+    client = addClient(otp, 200000000, ())
+    count = 20
+    elapsed = measure(lambda: client.sendObjects(otp.stateServer.getZoneObjects(200000000, (2000,))), count)
+    print("interest: %d objects | sendObjects %.2f ms, %.2f us/object" % (400, elapsed * 1e3, elapsed * 1e6 / 400))
+
+    do = otp.stateServer.objects[300000000]
+    dg = Datagram()
+    elapsed = measure(lambda: (do.packRequiredBroadcast(dg), do.packOther(dg)), 2000)
+    print("interest: DistributedToon | packRequiredBroadcast + packOther %.2f us" % (elapsed * 1e6))
+
+
+class RecordingTransport(BenchTransport):
+    """
+    Transport counting the messages of every type
+    """
+    def __init__(self):
+        BenchTransport.__init__(self)
+        self.messages = collections.Counter()
+
+    def write(self, data):
+        BenchTransport.write(self, data)
+
+        offset = 0
+        while offset < len(data):
+            size, code = struct.unpack_from("<HH", data, offset)
+            self.messages[code] += 1
+            offset += 2 + size
+
+
+def interestMessage(handle, parentId, zones):
+    dg = Datagram()
+    dg.addUint16(CLIENT_ADD_INTEREST)
+    dg.addUint16(handle)
+    dg.addUint32(0)
+    dg.addUint32(parentId)
+    for zoneId in zones:
+        dg.addUint32(zoneId)
+
+    return dg
+
+
+def benchTransitions():
+    """
+    A client opening, replacing and closing overlapping interests
+    on a crowded parent (100 objects in each zone), and objects moving
+    between zones it sees through two handles
+    """
+    otp = makeStateServer()
+    generate(otp, 200000000, "DistributedDistrict", 0, 0)
+    for n in range(1000):
+        generate(otp, 300000000 + n, "DistributedSuit", 200000000, 2000 + n % 10)
+
+    # The client has its avatar there too
+    client = addClient(otp, 200000000, ())
+    client.setAvatarId(generate(otp, 310000000, "DistributedToon", 200000000, 2000).doId)
+    del client.interests[1]
+    client.transport = RecordingTransport()
+
+    removeInterest = Datagram()
+    removeInterest.addUint16(CLIENT_REMOVE_INTEREST)
+    removeInterest.addUint16(1)
+    removeInterest.addUint32(0)
+
+    steps = (
+        ("add 2000-2004", interestMessage(1, 200000000, range(2000, 2005))),
+        ("add 2003-2007", interestMessage(2, 200000000, range(2003, 2008))),
+        ("replace 2005-2009", interestMessage(2, 200000000, range(2005, 2010))),
+        ("remove 2000-2004", removeInterest),
+    )
+
+    for name, dg in steps:
+        client.transport.messages.clear()
+        start = time.perf_counter()
+        client.onDatagram(dg)
+        elapsed = time.perf_counter() - start
+
+        messages = client.transport.messages
+        print("transitions: %-17s | %6.2f ms | %3d creates, %3d disables, %d objects seen" % (
+            name, elapsed * 1e3, messages[CLIENT_CREATE_OBJECT_REQUIRED_OTHER], messages[CLIENT_OBJECT_DISABLE],
+            len(otp.stateServer.getZoneObjects(200000000, [zoneId for zoneId in range(2000, 2010) if client.hasInterest(200000000, zoneId)])) - client.hasInterest(200000000, 2000)))
+
+    # Moves inside the interest, and in and out of it
+    client.onDatagram(interestMessage(1, 200000000, range(2000, 2005)))
+    client.transport.messages.clear()
+
+    do = otp.stateServer.objects[300000000]
+    count = 500
+    for n in range(count):
+        dg = Datagram()
+        dg.addUint32(200000000)
+        dg.addUint32(2000 + n % 20)
+        otp.stateServer.handle(do.doId, 4000000, STATESERVER_OBJECT_SET_ZONE, dg)
+
+    messages = client.transport.messages
+    print("transitions: %d moves over 20 zones | %d locations, %d creates, %d disables" % (
+        count, messages[CLIENT_OBJECT_LOCATION], messages[CLIENT_CREATE_OBJECT_REQUIRED_OTHER], messages[CLIENT_OBJECT_DISABLE]))
+
+
+def benchFanout():
+    """
+    Cost of an update, a move and a create seen by 3 clients,
+    with many other clients connected elsewhere
+    """
+    for count in (1000, 5000):
+        otp = makeStateServer()
+        generate(otp, 200000000, "DistributedDistrict", 0, 0)
+        do = generate(otp, 300000000, "DistributedToon", 200000000, 2000)
+
+        for n in range(count):
+            addClient(otp, 200000000, (2000 if n < 3 else 3000 + n % 100,))
+
+        field = do.dclass.getFieldByName("setSmPosHpr")
+        update = Datagram()
+        update.addUint32(do.doId)
+        update.addUint16(field.getNumber())
+        update.appendData(field.getDefaultValue())
+
+        def move():
+            for zoneId in (2001, 2000):
+                dg = Datagram()
+                dg.addUint32(200000000)
+                dg.addUint32(zoneId)
+                otp.stateServer.handle(do.doId, 4000000, STATESERVER_OBJECT_SET_ZONE, dg)
+
+        def create():
+            generate(otp, 300000001, "DistributedSuit", 200000000, 2000)
+            otp.stateServer.deleteObject(otp.stateServer.objects[300000001], 4000000)
+
+        updated = measure(lambda: otp.stateServer.handle(do.doId, 4000000, STATESERVER_OBJECT_UPDATE_FIELD, update), 2000)
+        moved = measure(move, 200) / 2
+        created = measure(create, 200)
+        print("fanout: %d clients, 3 interested | update %.1f us | move %.1f us | generate + delete %.1f us" % (count, updated * 1e6, moved * 1e6, created * 1e6))
+
+
+def benchPuppet():
+    """
+    A message to the puppet channel of an avatar, with many clients connected
+    """
+    for count in (1000, 5000):
+        otp = makeStateServer()
+        clients = [addClient(otp, 200000000, ()) for n in range(count)]
+        for n, client in enumerate(clients):
+            client.setAvatarId(300000000 + n)
+
+        dg = Datagram()
+        dg.addUint32(300000000 + count - 1)
+        dg.addUint16(0)
+
+        channel = 300000000 + count - 1 + (1 << 32)
+        elapsed = measure(lambda: otp.clientAgent.handle(channel, 4000000, STATESERVER_OBJECT_UPDATE_FIELD, dg), 2000)
+        print("puppet: %d clients | handle %.2f us" % (count, elapsed * 1e6))
+
+
+def benchGenerate():
+    """
+    Cost of a generate (StateServer side, nobody listening) and of its parts
+    """
+    otp = makeStateServer()
+    generate(otp, 200000000, "DistributedDistrict", 0, 0)
+
+    for name in ("DistributedToon", "DistributedSuit", "DistributedNPCToon"):
+        dclass = otp.dc.getClassByName(name)
+        count = 1000
+        messages = [generateMessage(dclass, 300000000 + n, 200000000, 2000) for n in range(count)]
+
+        def generateAll():
+            for dg in messages:
+                otp.stateServer.handle(20100000, 4000000, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, dg)
+
+        def deleteAll():
+            for n in range(count):
+                otp.stateServer.deleteObject(otp.stateServer.objects[300000000 + n], 4000000)
+
+        def unpackPack():
+            for dg in messages:
+                di = DatagramIterator(dg)
+                di.skipBytes(14)
+                do = DistributedObject(0, dclass, 0, 0)
+                do.receiveRequired(di)
+                do.packRequired(Datagram())
+
+        generated = measure(generateAll)
+        deleteAll()
+        unpacked = measure(unpackPack)
+        print("generate: %-18s | generate %.1f us | new object + receiveRequired + packRequired %.1f us" % (name, generated * 1e6 / count, unpacked * 1e6 / count))
+
+
+def benchFields():
+    """
+    Memory of a synthetic population, and cost of smooth node updates
+    """
+    otp = makeStateServer()
+    generate(otp, 200000000, "DistributedDistrict", 0, 0)
+
+    population = (("DistributedToon", 1000), ("DistributedSuit", 5000), ("DistributedNPCToon", 5000))
+    messages = []
+    for name, count in population:
+        dclass = otp.dc.getClassByName(name)
+        messages += [generateMessage(dclass, 300000000 + len(messages) + n, 200000000, 2000) for n in range(count)]
+
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    for dg in messages:
+        otp.stateServer.handle(20100000, 4000000, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, dg)
+
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("fields: %d objects | %.1f MB, %.0f bytes/object" % (len(messages), (used - start) / 1e6, (used - start) / len(messages)))
+
+    # setSmPosHpr updates on toons
+    dclass = otp.dc.getClassByName("DistributedToon")
+    field = dclass.getFieldByName("setSmPosHpr")
+
+    packer = DCPacker()
+    packer.beginPack(field)
+    field.packArgs(packer, (1.0, 2.0, 3.0, 90.0, 0.0, 0.0, 1234))
+    packer.endPack()
+    data = packer.getBytes()
+
+    updates = []
+    for n in range(1000):
+        dg = Datagram()
+        dg.addUint32(300000000 + n)
+        dg.addUint16(field.getNumber())
+        dg.appendData(data)
+        updates.append(dg)
+
+    def update():
+        for dg in updates:
+            otp.stateServer.handle(DatagramIterator(dg).getUint32(), 5000000, STATESERVER_OBJECT_UPDATE_FIELD, dg)
+
+    elapsed = measure(update, 4)
+    print("fields: setSmPosHpr update through the StateServer | %.2f us" % (elapsed * 1e6 / len(updates)))
+
+    do = otp.stateServer.objects[300000000]
+    component = dclass.getFieldByName("setComponentX").getNumber()
+    dg = Datagram()
+    elapsed = measure(lambda: do.packRequiredBroadcast(dg) or do.packOther(dg) or do.invalidate(component), 5000)
+    print("fields: DistributedToon packOther after an update | %.2f us" % (elapsed * 1e6))
+
+
+def benchMultiple():
+    """
+    An AI setting several broadcast fields of a toon seen by many clients,
+    one field at a time or with one STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE
+    """
+    otp = makeStateServer()
+    generate(otp, 200000000, "DistributedDistrict", 0, 0)
+    do = generate(otp, 300000000, "DistributedToon", 200000000, 2000)
+
+    clients = [addClient(otp, 200000000, (2000,)) for n in range(500)]
+
+    fields = [do.dclass.getInheritedField(index) for index in range(do.dclass.getNumInheritedFields())]
+    fields = [field for field in fields if field.asAtomicField() and field.isBroadcast() and not field.isOwnrecv()][:5]
+
+    singles = []
+    multiple = Datagram()
+    multiple.addUint32(do.doId)
+    multiple.addUint16(len(fields))
+
+    for field in fields:
+        dg = Datagram()
+        dg.addUint32(do.doId)
+        dg.addUint16(field.getNumber())
+        dg.appendData(field.getDefaultValue())
+        singles.append(dg)
+
+        multiple.addUint16(field.getNumber())
+        multiple.appendData(field.getDefaultValue())
+
+    def single():
+        for dg in singles:
+            otp.stateServer.handle(do.doId, 4000000, STATESERVER_OBJECT_UPDATE_FIELD, dg)
+
+    def batch():
+        otp.stateServer.handle(do.doId, 4000000, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE, multiple)
+
+    for name, function in (("UPDATE_FIELD x%d" % len(fields), single), ("UPDATE_FIELD_MULTIPLE", batch)):
+        writes = sum(client.transport.writes for client in clients)
+        elapsed = measure(function, 50)
+        writes = (sum(client.transport.writes for client in clients) - writes) / 50
+        print("multiple: %d fields, %d clients | %s %.2f ms, %d client writes" % (len(fields), len(clients), name, elapsed * 1e3, writes))
+
+
+def benchSmooth():
+    """
+    A crowded zone: every toon sends a few setSmPosHpr per tick,
+    sent to clients right away or coalesced per tick
+    """
+    otp = makeStateServer()
+    generate(otp, 200000000, "DistributedDistrict", 0, 0)
+    field = otp.dc.getClassByName("DistributedToon").getFieldByName("setSmPosHpr")
+    otp.clientAgent.smoothNodeFieldIds = {field.getNumber()}
+
+    packer = DCPacker()
+    packer.beginPack(field)
+    field.packArgs(packer, (1.0, 2.0, 3.0, 90.0, 0.0, 0.0, 1234))
+    packer.endPack()
+    data = packer.getBytes()
+
+    toons = 50
+    updatesPerTick = 5
+    ticks = 20
+
+    # Every toon has its client, and there are as many clients only looking
+    clients = []
+    for n in range(toons * 2):
+        client = addClient(otp, 200000000, (2000,))
+        if n < toons:
+            client.setAvatarId(generate(otp, 300000000 + n, "DistributedToon", 200000000, 2000).doId)
+
+        clients.append(client)
+
+    messages = []
+    for n in range(updatesPerTick * toons):
+        dg = Datagram()
+        dg.addUint32(300000000 + n % toons)
+        dg.addUint16(field.getNumber())
+        dg.appendData(data)
+        messages.append(dg)
+
+    def tick():
+        for dg in messages:
+            doId = DatagramIterator(dg).getUint32()
+            otp.stateServer.handle(doId, doId, STATESERVER_OBJECT_UPDATE_FIELD, dg)
+
+        if otp.clientAgent.pendingSmooth:
+            otp.clientAgent.flushSmooth()
+
+    for name, smoothTick in (("immediate", None), ("coalesced", 0.1)):
+        otp.clientAgent.smoothTick = smoothTick
+        writes = sum(client.transport.writes for client in clients)
+        written = sum(client.transport.written for client in clients)
+        elapsed = measure(tick, ticks)
+        writes = (sum(client.transport.writes for client in clients) - writes) / ticks
+        written = (sum(client.transport.written for client in clients) - written) / ticks
+
+        print("smooth: %d toons x %d updates, %d clients | %-9s %.2f ms/tick, %d client writes, %.0f KB/tick" % (
+            toons, updatesPerTick, len(clients), name, elapsed * 1e3, writes, written / 1e3))
+
+
+def benchZoneQuery():
+    """
+    STATESERVER_QUERY_ZONE_OBJECT_ALL on a few zones of a crowded district
+    """
+    otp = makeStateServer()
+    generate(otp, 200000000, "DistributedDistrict", 0, 0)
+    for n in range(50000):
+        generate(otp, 300000000 + n, "DistributedNPCToon", 200000000, 2000 + n % 100)
+
+    # The answer is streamed through callLater, we run the turns ourselves
+    pending = []
+    otp.callLater = lambda delay, callback, *args: pending.append((callback, args))
+
+    received = collections.Counter()
+    class Receiver:
+        def handle(self, channel, sender, code, datagram):
+            received[code] += 1
+
+    otp.registerChannel(4000001, Receiver())
+
+    zones = list(range(2000, 2010))
+    dg = Datagram()
+    dg.addUint32(1)
+    dg.addUint32(200000000)
+    dg.addUint16(len(zones))
+    for zoneId in zones:
+        dg.addUint32(zoneId)
+
+    turns = []
+    start = time.perf_counter()
+    otp.stateServer.handle(20100000, 4000001, STATESERVER_QUERY_ZONE_OBJECT_ALL, dg)
+    turns.append(time.perf_counter() - start)
+
+    while pending:
+        callback, args = pending.pop(0)
+        start = time.perf_counter()
+        callback(*args)
+        turns.append(time.perf_counter() - start)
+
+    print("zonequery: %d objects, %d of them in %d zones | %d answers + %d done, %.1f ms in %d turns, longest %.2f ms" % (
+        len(otp.stateServer.objects), received[STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER], len(zones),
+        received[STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER], received[STATESERVER_QUERY_ZONE_OBJECT_ALL_DONE],
+        sum(turns) * 1e3, len(turns), max(turns) * 1e3))
+
+    locations = {(200000000, zoneId) for zoneId in zones}
+    elapsed = measure(lambda: otp.stateServer.getZoneObjects(200000000, zones), 20)
+    print("zonequery: lookup with the location index %.3f ms" % (elapsed * 1e3))
+    elapsed = measure(lambda: [do for do in otp.stateServer.objects.values() if (do.parentId, do.zoneId) in locations], 20)
+    print("zonequery: lookup scanning every object %.3f ms" % (elapsed * 1e3))
+
+
+def benchSnapshot():
+    """
+    Snapshot and restore of 100k objects
+    """
+    otp = makeStateServer()
+    generate(otp, 200000000, "DistributedDistrict", 0, 0)
+    for n in range(100000):
+        dclassName = ("DistributedToon", "DistributedSuit", "DistributedNPCToon")[n % 3]
+        generate(otp, 300000000 + n, dclassName, 200000000, 2000 + n % 100)
+
+    # Snapshot batches are packed through callLater, we run the turns ourselves
+    pending = []
+    otp.callLater = lambda delay, callback, *args: pending.append((delay, callback, args))
+
+    path = os.path.join(tempfile.mkdtemp(), "objects.snapshot")
+    writer = SnapshotWriter(otp.stateServer, path)
+
+    turns = []
+    start = time.perf_counter()
+    writer.takeSnapshot()
+    turns.append(time.perf_counter() - start)
+
+    while pending[0][0] == 0:
+        delay, callback, args = pending.pop(0)
+        turnStart = time.perf_counter()
+        callback(*args)
+        turns.append(time.perf_counter() - turnStart)
+
+    while writer.lastDuration is None:
+        time.sleep(0.001)
+
+    elapsed = time.perf_counter() - start
+    print("snapshot: %d objects, %.1f MB | %.2f s written, %.2f s packing in %d turns, longest %.1f ms" % (
+        len(otp.stateServer.objects), os.path.getsize(path) / 1e6, elapsed, sum(turns), len(turns), max(turns) * 1e3))
+
+    restored = makeStateServer()
+    start = time.perf_counter()
+    count = restoreSnapshot(restored.stateServer, path)
+    print("snapshot: restore of %d objects | %.2f s" % (count, time.perf_counter() - start))
+
+    do, copy = otp.stateServer.objects[300000000], restored.stateServer.objects[300000000]
+    assert do.fields == copy.fields and do.senderId == copy.senderId and len(restored.stateServer.zones) == len(otp.stateServer.zones)
+    shutil.rmtree(os.path.dirname(path))
+
+
+def benchObjects():
+    """
+    Memory of an object, alone and in the StateServer (indexes included)
+    """
+    otp = makeStateServer()
+    generate(otp, 200000000, "DistributedDistrict", 0, 0)
+
+    count = 5000
+    for name in ("DistributedToon", "DistributedSuit", "DistributedNPCToon", "DistributedPet", "DistributedDoor", "DistributedTreasure"):
+        dclass = otp.dc.getClassByName(name)
+        messages = [generateMessage(dclass, 300000000 + n, 200000000, 2000) for n in range(count)]
+
+        tracemalloc.start()
+        start, _ = tracemalloc.get_traced_memory()
+        objects = []
+        for dg in messages:
+            di = DatagramIterator(dg)
+            di.skipBytes(14)
+            do = DistributedObject(0, dclass, 0, 0)
+            do.receiveRequired(di)
+            objects.append(do)
+
+        alone, _ = tracemalloc.get_traced_memory()
+        del objects
+
+        start, _ = tracemalloc.get_traced_memory()
+        for dg in messages:
+            otp.stateServer.handle(20100000, 4000000, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, dg)
+
+        used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        for n in range(count):
+            otp.stateServer.deleteObject(otp.stateServer.objects[300000000 + n], 4000000)
+
+        print("objects: %-19s | %.0f bytes/object, %.0f bytes/object in the StateServer" % (name, (alone - start) / count, (used - start) / count))
+
+
+def mdFrame(channel, sender, code, payload):
+    frame = struct.pack("<BQQH", 1, channel, sender, code) + payload
+    return struct.pack("<H", len(frame)) + frame
+
+
+def readFrames(sock, count):
+    """
+    Read count MD frames from a socket, return their codes
+    """
+    data = b""
+    codes = []
+    while len(codes) < count:
+        data += sock.recv(1 << 20)
+        while len(data) >= 2 and len(data) >= 2 + struct.unpack_from("<H", data)[0]:
+            length = struct.unpack_from("<H", data)[0]
+            codes.append(struct.unpack_from("<H", data, 19)[0])
+            data = data[2 + length:]
+
+    return codes
+
+
+def cpuTime(pid):
+    """
+    CPU time (in seconds) used by a process so far
+    """
+    with open("/proc/%d/stat" % pid) as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def childPids(pid):
+    pids = []
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open("/proc/%s/stat" % name) as file:
+                    if int(file.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        pids.append(int(name))
+
+            except OSError:
+                pass
+
+    return pids
+
+
+def sendUpdates(port, frames, count):
+    """
+    A client agent sending count field updates
+    """
+    sender = socket.create_connection(("127.0.0.1", port))
+    batch = b"".join(frames)
+
+    for _ in range(count // len(frames)):
+        sender.sendall(batch)
+
+    time.sleep(60)
+
+
+def benchPartitions():
+    """
+    Game clients sending updates to AI objects (clsend airecv fields), with the
+    StateServer in the main process or in partitions. Each AI is connected to the
+    MD of the partition having its objects (their doIds are in its doId % count),
+    or to the main MD. CPU is the time used by the processes during the updates.
+    """
+    dc = DCFile()
+    dc.read(Filename("etc", "otp.dc"))
+    dc.read(Filename("etc", "toon.dc"))
+
+    suit = dc.getClassByName("DistributedSuit")
+    field = suit.getFieldByName("requestBattle")
+
+    ais = 4
+    count = 50000
+    objects = 250
+
+    for run, (partitions, local) in enumerate(((0, False), (1, True), (2, True), (4, True), (2, False), (4, False))):
+        port = 7300 + run * 10
+        process = startMessageDirector(port, args=["--partitions", str(partitions), "--partition-port", str(port + 1)] if partitions else [])
+
+        ports = [port + 1 + n % partitions if local else port for n in range(ais)]
+        modulo = max(partitions, 1)
+
+        # Every AI owns objects with doId % modulo == its index % modulo
+        sockets = []
+        doIds = []
+        for n in range(ais):
+            while True:
+                try:
+                    ai = socket.create_connection(("127.0.0.1", ports[n]))
+                    break
+
+                except OSError:
+                    time.sleep(0.1)
+
+            control = struct.pack("<BQHQ", 1, CONTROL_MESSAGE, CONTROL_SET_CHANNEL, 4000000 + n)
+            ai.sendall(struct.pack("<H", len(control)) + control)
+            sockets.append(ai)
+            doIds.append([300000000 + (n * objects + index) * modulo + n % modulo for index in range(objects)])
+
+        # We wait for every partition, by generating an object in each one until it answers
+        for n, ai in enumerate(sockets):
+            ai.settimeout(0.5)
+            while True:
+                doId = 400000000 + n * modulo + n % modulo
+                ai.sendall(mdFrame(20100000, 4000000 + n, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, bytes(generateMessage(suit, doId, 200000000, 2000))))
+                ai.sendall(mdFrame(doId, 4000000 + n, STATESERVER_QUERY_OBJECT_ALL, struct.pack("<I", doId)))
+
+                try:
+                    readFrames(ai, 1)
+                    break
+
+                except socket.timeout:
+                    time.sleep(0.5)
+
+            ai.settimeout(None)
+
+            # The objects, and a query to know they're all generated
+            for doId in doIds[n]:
+                ai.sendall(mdFrame(20100000, 4000000 + n, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, bytes(generateMessage(suit, doId, 200000000, 2000))))
+
+            ai.sendall(mdFrame(doIds[n][-1], 4000000 + n, STATESERVER_QUERY_OBJECT_ALL, struct.pack("<I", doIds[n][-1])))
+            readFrames(ai, 1)
+
+        pids = [process.pid] + childPids(process.pid)
+        cpu = [cpuTime(pid) for pid in pids]
+
+        # Updates from clients, each AI receives the updates of its objects
+        payload = field.getDefaultValue()
+        frames = [[mdFrame(doId, 10000000 + index, STATESERVER_OBJECT_UPDATE_FIELD, struct.pack("<IH", doId, field.getNumber()) + payload)
+                   for index, doId in enumerate(doIds[n])] for n in range(ais)]
+        size = ais * count * len(frames[0][0])
+
+        workers = [multiprocessing.Process(target=sendUpdates, args=(ports[n], frames[n], count)) for n in range(ais)]
+
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+
+        selector = selectors.DefaultSelector()
+        for ai in sockets:
+            selector.register(ai, selectors.EVENT_READ)
+
+        while size > 0:
+            for key, mask in selector.select():
+                size -= len(key.fileobj.recv(1 << 20))
+
+        elapsed = time.perf_counter() - start
+        cpu = [cpuTime(pid) - used for pid, used in zip(pids, cpu)]
+
+        for worker in workers:
+            worker.kill()
+            worker.join()
+
+        for ai in sockets:
+            ai.close()
+
+        process.kill()
+        process.wait()
+        time.sleep(1)
+
+        if not partitions:
+            name = "in process"
+
+        else:
+            name = "%d partitions, AIs on the %s MD" % (partitions, "partition" if local else "main")
+
+        print("partitions: %d updates to %d objects, StateServer %s | %.0f updates/s, CPU main %.2f s, partitions %s" % (
+            ais * count, ais * objects, name, ais * count / elapsed, cpu[0], " + ".join("%.2f" % used for used in cpu[1:]) + " s" if partitions else "-"))
+
+
+BENCHMARKS = {
+    "ranges": benchRanges,
+    "messages": benchMessages,
+    "federation": benchFederation,
+    "fairness": benchFairness,
+    "shardrest": benchShardRest,
+    "interest": benchInterest,
+    "fanout": benchFanout,
+    "transitions": benchTransitions,
+    "puppet": benchPuppet,
+    "generate": benchGenerate,
+    "fields": benchFields,
+    "multiple": benchMultiple,
+    "smooth": benchSmooth,
+    "zonequery": benchZoneQuery,
+    "snapshot": benchSnapshot,
+    "objects": benchObjects,
+    "partitions": benchPartitions,
+}
+
+
+if __name__ == "__main__":
+    random.seed(0)
+
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -1,17 +1,31 @@
 from panda3d.core import Datagram, DatagramIterator
 from panda3d.direct import DCPacker
 from zone_util import getCanonicalZoneId, getTrueZoneId
+from framing import FrameBuffer, FrameError
+from dc_layout import getLayout, MOLECULAR, CLSEND, OWNSEND
 from msgtypes import *
+import asyncio
 import struct
 import math
 import os
 import time
 
-class Client:
-    def __init__(self, agent, sock, addr):
+# DistributedNode and DistributedSmoothNode fields.
+# These are sent very often and can be dropped for slow clients.
+SMOOTH_NODE_FIELDS = ("setX", "setY", "setZ", "setH", "setP", "setR", "setPos", "setHpr", "setPosHpr", "setXY", "setXZ", "setXYH", "setXYZH",
+                      "setComponentL", "setComponentX", "setComponentY", "setComponentZ", "setComponentH", "setComponentP", "setComponentR", "setComponentT",
+                      "setSmStop", "setSmH", "setSmZ", "setSmXY", "setSmXZ", "setSmPos", "setSmHpr", "setSmXYZH", "setSmPosHpr", "setSmPosHprL",
+                      "clearSmoothing", "suggestResync", "returnResync")
+
+class Client(asyncio.BufferedProtocol):
+    __slots__ = ("agent", "transport", "addr", "otp", "messageDirector", "databaseServer", "stateServer",
+                 "frameBuffer", "interests", "avatarId", "account", "__interestCache", "knownObjects",
+                 "writePaused", "slowConsumerTimer")
+    
+    def __init__(self, agent):
         self.agent = agent
-        self.sock = sock
-        self.addr = addr
+        self.transport = None
+        self.addr = None
 
         # Quick access for OTP
         self.otp = self.agent.otp
@@ -20,7 +34,7 @@ class Client:
         self.stateServer = self.otp.stateServer
 
         # State stuff
-        self.buffer = bytearray()
+        self.frameBuffer = FrameBuffer(self.agent.maxFrameSize, self.agent.readBufferLimit)
         self.interests = {}
 
         # Account stuff
@@ -33,6 +47,15 @@ class Client:
         # we're just gonna use a set
         self.__interestCache = set()
         
+        # Objects the client has (we sent their creation and no disable since),
+        # except our own avatar
+        self.knownObjects = set()
+        
+        # Backpressure: when our transport buffer is above the high watermark,
+        # droppable messages are not sent
+        self.writePaused = False
+        self.slowConsumerTimer = None
+        
         
     def disconnect(self, index=None):
         datagram = Datagram()
@@ -42,21 +65,83 @@ class Client:
             
         self.sendMessage(CLIENT_GO_GET_LOST, datagram)
         
-        # Now we disconnect the client
-        self.sock.close()
+        # Now we disconnect the client. connection_lost will delete it from OTP.
+        self.transport.close()
+        
+        
+    def onAvatarDelete(self):
+        # Our avatar got deleted
+        self.otp.unregisterChannel(self.avatarId + (1<<32), self.agent)
+        self.setAvatarId(0)
+        self.disconnect(CLIENT_GO_GET_LOST_DISTRICT_RESET)
+        
+        
+    def setAvatarId(self, avatarId):
+        """
+        Set our avatar (0 if we don't have one anymore)
+        """
+        if self.agent.avatarClients.get(self.avatarId) is self:
+            del self.agent.avatarClients[self.avatarId]
+            
+        self.avatarId = avatarId
+        if avatarId:
+            self.agent.avatarClients[avatarId] = self
+            
+            
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.set_write_buffer_limits(self.agent.writeHighWatermark, self.agent.writeLowWatermark)
+        self.addr = transport.get_extra_info("peername")
+        self.agent.clients.append(self)
         
-        # This is not gonna call itself
-        self.onLost()
         
-        # Now we delete the client from OTP
-        del self.otp.clients[self.sock]
+    def get_buffer(self, sizehint):
+        return self.frameBuffer.getBuffer()
+        
+        
+    def buffer_updated(self, nbytes):
+        self.frameBuffer.bufferUpdated(nbytes)
+        
+        try:
+            for frame in self.frameBuffer.frames():
+                self.onDatagram(Datagram(bytes(frame)))
+                
+                # We might have been disconnected by this message
+                if self.transport.is_closing():
+                    break
+                    
+        except FrameError as e:
+            print("Dropping client %d: %s" % (self.avatarId, e))
+            self.transport.abort()
+            
+            
+    def connection_lost(self, exc):
+        if self.slowConsumerTimer:
+            self.slowConsumerTimer.cancel()
+            self.slowConsumerTimer = None
+            
         self.agent.clients.remove(self)
+        self.agent.removeClientLocations(self, self.__interestCache)
+        self.onLost()
         
         
-    def onAvatarDelete(self):
-        # Our avatar got deleted
-        self.avatarId = 0
-        self.disconnect(153)
+    def pause_writing(self):
+        # Our client is not reading fast enough
+        self.writePaused = True
+        self.agent.counters["writePaused"] += 1
+        
+        
+    def resume_writing(self):
+        self.writePaused = False
+        
+        
+    def onSlowConsumerTimeout(self):
+        self.slowConsumerTimer = None
+        
+        # Still over the hard limit, we're giving up on this client
+        if self.transport.get_write_buffer_size() > self.agent.writeHardLimit and not self.transport.is_closing():
+            self.agent.counters["slowConsumerDisconnects"] += 1
+            self.disconnect(CLIENT_GO_GET_LOST_SLOW_CONSUMER)
         
         
     def onLost(self):
@@ -65,19 +150,6 @@ class Client:
             self.chooseAvatar(0)
 
 
-    def onData(self, data):
-        self.buffer += data
-        while len(self.buffer) >= 2:
-            length = struct.unpack("<H", self.buffer[:2])[0]
-            if len(self.buffer) < length+2:
-                break
-
-            packet = self.buffer[2:length+2]
-            self.buffer = self.buffer[length+2:]
-
-            self.onDatagram(Datagram(bytes(packet)))
-
-
     def onDatagram(self, dg):
         di = DatagramIterator(dg)
 
@@ -342,63 +414,13 @@ class Client:
                     # We want to add the "main" zone, i.e 2200 for 2205, etc
                     zones.add(zoneId - zoneId % 100)
 
-            # This is set to an empty tuple because it's only defined if
-            # it's overwriting an interest, but needed anyway.
-            oldZones = ()
-
-            if handle in self.interests:
-                # Our interest is overwriting another interest:
-                #
-                # - if the parent id is different, we're just gonna remove it by
-                #   disabling every object present in the old zones if we're not interested
-                #   in them anymore.
-                #
-                # - if it's the same parent id, we're gonna do some intersection stuff and
-                #   only send from the new zones and remove from the old zones,
-                #   basically not sending anything for the zones in the intersection
-
-                # We get the old interest
-                oldParentId, oldZones = self.interests[handle]
-
-                # We remove it
-                del self.interests[handle]
-                self.updateInterestCache()
-
-                # We gotta disable the objects we can't see anymore,
-                if oldParentId == parentId:
-                    for do in self.stateServer.objects.values():
-                        # If the object is not visible anymore, we disable it
-                        # (it's in the removed interest zones, but not in the new interest (or any current interest) zones)
-                        if do.parentId == parentId and do.zoneId in oldZones and not (do.zoneId in zones or self.hasInterest(do.parentId, do.zoneId)):
-                            dg = Datagram()
-                            dg.addUint32(do.doId)
-                            self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
-
-                else:
-                    # We only check if we're no longer interested in
-                    for do in self.stateServer.objects.values():
-                        if do.parentId == oldParentId and do.zoneId in oldZones and not self.hasInterest(do.parentId, do.zoneId):
-                            dg = Datagram()
-                            dg.addUint32(do.doId)
-                            self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
-
-                    # We set oldZones to an empty tuple
-                    # (because we're ignoring them as parentId is difference)
-                    oldZones = ()
-
-            # We send the newly visible objects
-            newZones = []
-            for zoneId in zones:
-                if not zoneId in oldZones and not self.hasInterest(parentId, zoneId):
-                    newZones.append(zoneId)
-
-            # We have got a new zone list, we can finally send the objects.
-            self.sendObjects(parentId, newZones)
-
-            # We save the interest
+            # We save the interest (replacing the previous one with this handle)
             self.interests[handle] = (parentId, zones)
             self.updateInterestCache()
 
+            # We create what's now visible, and disable what's not anymore
+            self.updateKnownObjects()
+            
             # We tell the client we're done
             dg = Datagram()
             dg.addUint16(handle)
@@ -415,19 +437,12 @@ class Client:
             if not handle in self.interests:
                 raise Exception("Client tried to remove an unexisting interest")
 
-            # We get what the interest was
-            oldParentId, oldZones = self.interests[handle]
-
             # We remove the interest
             del self.interests[handle]
             self.updateInterestCache()
 
             # We disable all the objects we're no longer interested in
-            for do in self.stateServer.objects.values():
-                if do.parentId == oldParentId and do.zoneId in oldZones and not self.hasInterest(do.parentId, do.zoneId):
-                    dg = Datagram()
-                    dg.addUint32(do.doId)
-                    self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
+            self.updateKnownObjects()
 
             # We tell the client we're done
             dg = Datagram()
@@ -474,15 +489,12 @@ class Client:
             if not field:
                 raise Exception("Attempt to update a field but it was not found")
 
-            if not (field.isClsend() or (field.isOwnsend() and do.doId == self.avatarId)): # We probably should check for owner stuff too but Toontown does not implement it
+            flags = do.layout.flags.get(fieldId, 0)
+            if not (flags & CLSEND or (flags & OWNSEND and do.doId == self.avatarId)): # We probably should check for owner stuff too but Toontown does not implement it
                 raise Exception("Attempt to update a field but we don't have the rights")
 
             # Ignore DistributedNode and DistributedSmoothNode fields for debugging
-            if field.getName() not in ("setX", "setY", "setZ", "setH", "setP", "setR", "setPos", "setHpr", "setPosHpr", "setXY", "setXZ", "setXYH", "setXYZH",
-                                       "setComponentL", "setComponentX", "setComponentY", "setComponentZ", "setComponentH", "setComponentP", "setComponentR", "setComponentT",
-                                       "setSmStop", "setSmH", "setSmZ", "setSmXY", "setSmXZ", "setSmPos", "setSmHpr", "setSmXYZH", "setSmPosHpr", "setSmPosHprL",
-                                       "clearSmoothing", "suggestResync", "returnResync"):
-
+            if field.getName() not in SMOOTH_NODE_FIELDS:
                 print("Avatar %d updates %d (dclass %s) field %s" % (self.avatarId, do.doId, do.dclass.getName(), field.getName()))
 
 
@@ -565,12 +577,11 @@ class Client:
     def packDetails(self, dclass, fields):
         # Pack required fields.
         fieldPacker = DCPacker()
-        for i in range(dclass.getNumInheritedFields()):
-            field = dclass.getInheritedField(i)
-            if not field.isRequired() or field.asMolecularField():
+        layout = getLayout(dclass)
+        for number, k, field in layout.allRequired:
+            if layout.flags[number] & MOLECULAR:
                 continue
 
-            k = field.getName()
             v = fields.get(k, None)
 
             fieldPacker.beginPack(field)
@@ -608,10 +619,15 @@ class Client:
             dg.addUint8(pos)
             dg.addUint8(0)
 
-    def sendMessage(self, code, datagram):
+    def sendMessage(self, code, datagram, droppable=False):
         """
-        Send a message
+        Send a message.
+        Droppable messages are not sent if the client is not reading fast enough.
         """
+        if droppable and self.writePaused:
+            self.agent.counters["droppedMessages"] += 1
+            return
+            
         dg = Datagram()
         dg.addUint16(code)
         dg.appendData(datagram.getMessage())
@@ -622,8 +638,18 @@ class Client:
         """
         Send a datagram
         """
-        self.sock.send(struct.pack("<H", dg.getLength()))
-        self.sock.send(bytes(dg))
+        self.sendFrames(struct.pack("<H", dg.getLength()) + bytes(dg))
+
+
+    def sendFrames(self, data):
+        """
+        Send already framed messages
+        """
+        self.transport.write(data)
+        
+        # If we're staying over the hard limit, we'll disconnect the client
+        if self.slowConsumerTimer is None and self.transport.get_write_buffer_size() > self.agent.writeHardLimit:
+            self.slowConsumerTimer = self.otp.callLater(self.agent.slowConsumerTimeout, self.onSlowConsumerTimeout)
 
 
     def hasInterest(self, parentId, zoneId):
@@ -635,30 +661,46 @@ class Client:
 
 
     def updateInterestCache(self):
-        self.__interestCache.clear()
+        cache = set()
 
         for handle in self.interests:
             parentId, zones = self.interests[handle]
 
             for zoneId in zones:
-                self.__interestCache.add((parentId, zoneId))
+                cache.add((parentId, zoneId))
+        
+        # The ClientAgent keeps an index of who is interested in each location
+        self.agent.removeClientLocations(self, self.__interestCache - cache)
+        self.agent.addClientLocations(self, cache - self.__interestCache)
+        self.__interestCache = cache
 
         return False
 
-    def sendObjects(self, parentId, zones):
-        objects = []
-        for do in self.stateServer.objects.values():
-            # We're not sending our own object because
-            # we already know who we are (we are the owner)
-            if do.doId == self.avatarId:
-                continue
-
-            # If the object is in one of the new interest zones, we get it
-            if do.parentId == parentId and do.zoneId in zones:
-                objects.append(do)
+    def updateKnownObjects(self):
+        """
+        Compare the objects we sent to the client with the objects in our interests:
+        create the new ones, disable the ones we can't see anymore
+        """
+        visible = {}
+        for location in self.__interestCache:
+            if location in self.stateServer.zones:
+                visible.update(self.stateServer.zones[location])
+        
+        # We're not sending our own object because
+        # we already know who we are (we are the owner)
+        visible.pop(self.avatarId, None)
+        
+        for doId in sorted(self.knownObjects - visible.keys()):
+            dg = Datagram()
+            dg.addUint32(doId)
+            self.sendMessage(CLIENT_OBJECT_DISABLE, dg)
+        
+        self.sendObjects([visible[doId] for doId in visible.keys() - self.knownObjects])
+        self.knownObjects = set(visible)
 
+    def sendObjects(self, objects):
         # We sort them by dclass (fix some issues)
-        objects.sort(key = lambda x: x.dclass.getNumber())
+        objects.sort(key = lambda x: (x.dclass.getNumber(), x.doId))
 
         # We send every object
         for do in objects:
@@ -699,7 +741,10 @@ class Client:
             # (tl;dr it's blocking), so we won't.
 
             # We remember who we are
-            self.avatarId = avatar.doId
+            self.setAvatarId(avatar.doId)
+
+            # We're now receiving the messages sent to our puppet
+            self.otp.registerChannel(self.avatarId + (1<<32), self.agent)
 
             # We can send that we are the proud owner of a DistributedToon!
             dg = Datagram()
@@ -716,4 +761,5 @@ class Client:
             dg = Datagram()
             dg.addUint32(self.avatarId)
             self.messageDirector.sendMessage([self.avatarId], self.avatarId, STATESERVER_OBJECT_DELETE_RAM, dg)
-            self.avatarId = 0
\ No newline at end of file
+            self.otp.unregisterChannel(self.avatarId + (1<<32), self.agent)
+            self.setAvatarId(0)
\ No newline at end of file
@@ -1,7 +1,11 @@
 from panda3d.core import Datagram, Filename
 from dnaparser import loadDNAFile, DNAStorage
+from client import SMOOTH_NODE_FIELDS
+from dc_layout import OWNRECV, BROADCAST
 from msgtypes import *
+import collections
 import socket
+import struct
 import time
 import ssl
 
@@ -14,19 +18,82 @@ class ClientAgent:
         # DC File
         self.dc = self.otp.dc
         
-        # GameServer Sock
-        sock = socket.socket()
-        sock.bind(("0.0.0.0", 6667))
-        sock.listen(5)
+        # GameServer sock and its SSL context, once we're listening
+        self.sock = None
+        self.sslContext = None
         
-        # SSL Context
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        context.load_cert_chain('server.cert', 'server.key')
-
-        # GameServer sock and clients
-        self.sock = context.wrap_socket(sock, server_side=True)
+        # Clients
         self.clients = []
         
+        # Location index: (parentId, zoneId) -> clients interested in it
+        self.zoneClients = {}
+        
+        # avatarId -> client, for the owners of objects
+        self.avatarClients = {}
+        
+        # Outbound queue limits for each client (in bytes).
+        # Above the high watermark, droppable messages (smooth node updates) are dropped.
+        # A client staying above the hard limit for slowConsumerTimeout seconds is disconnected.
+        self.writeHighWatermark = 64 * 1024
+        self.writeLowWatermark = 16 * 1024
+        self.writeHardLimit = 1024 * 1024
+        self.slowConsumerTimeout = 5.0
+        
+        # Inbound limits for each client (in bytes). Game clients only send small messages.
+        self.maxFrameSize = 16 * 1024
+        self.readBufferLimit = 64 * 1024
+        
+        # How often we paused, dropped and disconnected
+        self.counters = collections.Counter()
+        
+        # Smooth node updates coalescing: if set, smooth node updates are sent
+        # to clients every smoothTick seconds, only the latest of each (object, field).
+        self.smoothTick = None
+        
+        # (doId, field number) -> (object, frame, sender) waiting for the tick
+        self.pendingSmooth = {}
+        
+        # Visible zones of each zone, see loadDNA
+        self.visgroups = {}
+        
+        # We read the NameMaster
+        self.nameDictionary = {}
+        with open("etc/NameMaster.txt", "r") as file:
+            for line in file:
+                if line.startswith("#"):
+                    continue
+                    
+                nameId, nameCategory, name = line.split("*", 2)
+                self.nameDictionary[int(nameId)] = (int(nameCategory), name.strip())
+                
+        # Special fields IDs (cache)
+        self.setTalkFieldId = self.dc.getClassByName("TalkPath_owner").getFieldByName("setTalk").getNumber()
+        
+        self.smoothNodeFieldIds = set()
+        for n in range(self.dc.getNumClasses()):
+            dclass = self.dc.getClass(n)
+            for index in range(dclass.getNumInheritedFields()):
+                field = dclass.getInheritedField(index)
+                if field.getName() in SMOOTH_NODE_FIELDS:
+                    self.smoothNodeFieldIds.add(field.getNumber())
+        
+            
+    def listen(self):
+        """
+        Open the GameServer socket. Client sockets are wrapped when they're accepted.
+        """
+        self.sslContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.sslContext.load_cert_chain('server.cert', 'server.key')
+        
+        self.sock = socket.socket()
+        self.sock.bind(("0.0.0.0", 6667))
+        self.sock.listen(5)
+        
+        
+    def loadDNA(self):
+        """
+        Load the visgroups of the DNA files
+        """
         # Every DNA file with visgroups. We don't care about all of them.
         dnaFiles = [
             "cog_hq_cashbot_sz.dna",
@@ -65,7 +132,6 @@ class ClientAgent:
         ]
         
         # We cache the visgroups
-        self.visgroups = {}
         dnaStore = DNAStorage()
         
         for filename in dnaFiles:
@@ -74,20 +140,39 @@ class ClientAgent:
         for visgroup in dnaStore.visGroups:
             self.visgroups[int(visgroup.name)] = [int(i) for i in visgroup.visibles]
             
-        # We read the NameMaster
-        self.nameDictionary = {}
-        with open("etc/NameMaster.txt", "r") as file:
-            for line in file:
-                if line.startswith("#"):
-                    continue
-                    
-                nameId, nameCategory, name = line.split("*", 2)
-                self.nameDictionary[int(nameId)] = (int(nameCategory), name.strip())
+            
+    def addClientLocations(self, client, locations):
+        for location in locations:
+            if location in self.zoneClients:
+                self.zoneClients[location].add(client)
                 
-        # Special fields IDs (cache)
-        self.setTalkFieldId = self.dc.getClassByName("TalkPath_owner").getFieldByName("setTalk").getNumber()
-        
+            else:
+                self.zoneClients[location] = {client}
+                
+                
+    def removeClientLocations(self, client, locations):
+        for location in locations:
+            clients = self.zoneClients[location]
+            clients.discard(client)
+            if not clients:
+                del self.zoneClients[location]
+                
+                
+    def getClients(self, do, *locations):
+        """
+        Get the clients interested in these locations, and the owner of the object
+        """
+        clients = set()
+        for location in locations:
+            clients.update(self.zoneClients.get(location, ()))
             
+        owner = self.avatarClients.get(do.doId)
+        if owner is not None:
+            clients.add(owner)
+            
+        return clients
+        
+        
     def announceCreate(self, do, sender):
         # We send to the interested clients that they have access to a brand new object!
         dg = Datagram()
@@ -98,14 +183,15 @@ class ClientAgent:
         do.packRequiredBroadcast(dg)
         do.packOther(dg)
         
-        for client in self.clients:
+        # We send the object creation if we're the owner or if we're interested.
+        for client in self.getClients(do, (do.parentId, do.zoneId)):
             # No echo pls
             if client.avatarId == sender:
                 continue
                 
-            # We send the object creation if we're the owner or if we're interested.
-            if client.hasInterest(do.parentId, do.zoneId) or do.doId == client.avatarId:
-                client.sendMessage(CLIENT_CREATE_OBJECT_REQUIRED_OTHER, dg)
+            client.sendMessage(CLIENT_CREATE_OBJECT_REQUIRED_OTHER, dg)
+            if do.doId != client.avatarId:
+                client.knownObjects.add(do.doId)
         
         
     def announceDelete(self, do, sender):
@@ -113,7 +199,8 @@ class ClientAgent:
         dg = Datagram()
         dg.addUint32(do.doId)
         
-        for client in self.clients:
+        # We tell the client that it's disabled only if they're interested or the owner.
+        for client in self.getClients(do, (do.parentId, do.zoneId)):
             # Not retransmitting
             if client.avatarId == sender:
                 continue
@@ -122,12 +209,48 @@ class ClientAgent:
             if do.doId == client.avatarId:
                 client.onAvatarDelete()
             
-            # We tell the client that it's disabled only if they're interested or the owner.
-            # (Please note this last condition here is useless but it's meant to be replaced if owner view is implemented some day)
-            elif client.hasInterest(do.parentId, do.zoneId) or do.doId == client.avatarId:
+            else:
                 client.sendMessage(CLIENT_OBJECT_DISABLE, dg)
+                client.knownObjects.discard(do.doId)
         
         
+    def announceDeleteMany(self, objects, sender):
+        """
+        Announce the deletion of many objects (shard going down).
+        Each client gets its disables in a single write.
+        """
+        # We frame every disable message once, grouped by location
+        doIds = set()
+        locations = {}
+        for do in objects:
+            doIds.add(do.doId)
+            frame = struct.pack("<HHI", 6, CLIENT_OBJECT_DISABLE, do.doId)
+            locations.setdefault((do.parentId, do.zoneId), []).append(frame)
+            
+        # We only look at the clients interested in these locations
+        clientFrames = {}
+        for location, frames in locations.items():
+            for client in self.zoneClients.get(location, ()):
+                clientFrames.setdefault(client, []).extend(frames)
+                
+        # The owners are disconnected
+        owners = [self.avatarClients[doId] for doId in doIds if doId in self.avatarClients]
+        for client in owners:
+            clientFrames.pop(client, None)
+            
+            # Not retransmitting
+            if client.avatarId != sender:
+                client.onAvatarDelete()
+                
+        for client, data in clientFrames.items():
+            # Not retransmitting
+            if client.avatarId == sender:
+                continue
+                
+            client.sendFrames(b"".join(data))
+            client.knownObjects.difference_update(doIds)
+                
+                
     def announceMove(self, do, prevParentId, prevZoneId, sender):
         """
         Send CLIENT_OBJECT_LOCATION to interested clients,
@@ -152,7 +275,7 @@ class ClientAgent:
         do.packRequiredBroadcast(dg3)
         do.packOther(dg3)
         
-        for client in self.clients:
+        for client in self.getClients(do, (prevParentId, prevZoneId), (do.parentId, do.zoneId)):
             # We are not transmitting back our own updates
             if client.avatarId == sender:
                 continue
@@ -161,8 +284,8 @@ class ClientAgent:
             if client.avatarId == do.doId:
                 client.sendMessage(CLIENT_OBJECT_LOCATION, dg2)
                 
-            # If we're interested in the previous area
-            elif client.hasInterest(prevParentId, prevZoneId):
+            # If the client has the object
+            elif do.doId in client.knownObjects:
                 # If we're interested in the new area,
                 # we can just tell the client that the object moved
                 if client.hasInterest(do.parentId, do.zoneId):
@@ -170,11 +293,13 @@ class ClientAgent:
                 else:   
                     # If we're not, we ask them to disable the object
                     client.sendMessage(CLIENT_OBJECT_DISABLE, dg1)
+                    client.knownObjects.discard(do.doId)
                     
             # If we're only interested in the new area,
             # we ask them to create the object
             elif client.hasInterest(do.parentId, do.zoneId):
                 client.sendMessage(CLIENT_CREATE_OBJECT_REQUIRED_OTHER, dg3)
+                client.knownObjects.add(do.doId)
                 
                 
     def announceUpdate(self, do, field, data, sender):
@@ -182,8 +307,12 @@ class ClientAgent:
         Send CLIENT_OBJECT_UPDATE_FIELD to interested clients
         """
         # This field has no reason to be transmitted if it's not ownrecv or broadcast
-        if not (field.isOwnrecv() or field.isBroadcast()):
+        flags = do.layout.flags.get(field.getNumber(), 0)
+        if not flags & (OWNRECV | BROADCAST):
             return
+        
+        # Only the owner can receive this update
+        ownerOnly = flags & OWNRECV or not flags & BROADCAST
             
         # We generate the field update
         dg = Datagram()
@@ -191,35 +320,151 @@ class ClientAgent:
         dg.addUint16(field.getNumber())
         dg.appendData(data)
         
-        for client in self.clients:
+        # Smooth node updates can be dropped for slow clients
+        droppable = field.getNumber() in self.smoothNodeFieldIds
+        
+        # They may wait for the next tick too
+        if droppable and not ownerOnly and self.smoothTick is not None:
+            frame = struct.pack("<HHIH", 8 + len(data), CLIENT_OBJECT_UPDATE_FIELD, do.doId, field.getNumber()) + data
+            self.queueSmooth(do, field.getNumber(), frame, sender)
+            return
+        
+        # If we're interested OR owner, we send the update
+        if ownerOnly:
+            clients = self.getClients(do)
+            
+        else:
+            clients = self.getClients(do, (do.parentId, do.zoneId))
+            
+        for client in clients:
             # We are not transmitting back our own updates
             if client.avatarId == sender:
                 continue
                 
-            # Can this client receive this update?
-            # TODO: is broadcast check required?
-            if (field.isOwnrecv() or not field.isBroadcast()) and client.avatarId != do.doId:
+            client.sendMessage(CLIENT_OBJECT_UPDATE_FIELD, dg, droppable)
+    
+    
+    def announceUpdates(self, do, updates, sender):
+        """
+        Send several CLIENT_OBJECT_UPDATE_FIELD to interested clients,
+        as one write per client
+        """
+        # We frame every update once. Owners get every transmitted field,
+        # other clients only the broadcast ones.
+        ownerFrames = []
+        frames = []
+        
+        for field, data in updates:
+            flags = do.layout.flags.get(field.getNumber(), 0)
+            if not flags & (OWNRECV | BROADCAST):
+                continue
+            
+            frame = struct.pack("<HHIH", 8 + len(data), CLIENT_OBJECT_UPDATE_FIELD, do.doId, field.getNumber()) + data
+            
+            # Smooth node updates can be dropped for slow clients
+            droppable = field.getNumber() in self.smoothNodeFieldIds
+            
+            # They may wait for the next tick too
+            if droppable and not flags & OWNRECV and self.smoothTick is not None:
+                self.queueSmooth(do, field.getNumber(), frame, sender)
                 continue
+            
+            ownerFrames.append((frame, droppable))
+            if not flags & OWNRECV:
+                frames.append((frame, droppable))
+        
+        if not ownerFrames:
+            return
+        
+        # Only the owner gets the ownrecv fields
+        locations = [(do.parentId, do.zoneId)] if frames else []
+        
+        for client in self.getClients(do, *locations):
+            # We are not transmitting back our own updates
+            if client.avatarId == sender:
+                continue
+            
+            if client.avatarId == do.doId:
+                self.sendUpdates(client, ownerFrames)
+            
+            else:
+                self.sendUpdates(client, frames)
+    
+    
+    def queueSmooth(self, do, number, frame, sender):
+        """
+        Keep a smooth node update for the next tick, replacing the previous one
+        """
+        if not self.pendingSmooth:
+            self.otp.callLater(self.smoothTick, self.flushSmooth)
+            
+        key = (do.doId, number)
+        if key in self.pendingSmooth:
+            self.counters["coalescedMessages"] += 1
+            
+        self.pendingSmooth[key] = (do, frame, sender)
+        
+        
+    def flushSmooth(self):
+        """
+        Send the smooth node updates of this tick, as one write per client.
+        Interests are checked now, the object may have moved since.
+        """
+        pending, self.pendingSmooth = self.pendingSmooth, {}
+        
+        # We group the updates by location
+        locations = {}
+        clientFrames = {}
+        for do, frame, sender in pending.values():
+            # The object may be gone
+            if self.otp.stateServer.objects.get(do.doId) is not do:
+                continue
+                
+            locations.setdefault((do.parentId, do.zoneId), []).append((frame, sender))
+            
+            # The owner gets its object updates even if it's not interested
+            owner = self.avatarClients.get(do.doId)
+            if owner is not None and sender != owner.avatarId and not owner.hasInterest(do.parentId, do.zoneId):
+                clientFrames.setdefault(owner, []).append((frame, True))
+                
+        for location, updates in locations.items():
+            for client in self.zoneClients.get(location, ()):
+                # We are not transmitting back our own updates
+                clientFrames.setdefault(client, []).extend((frame, True) for frame, sender in updates if sender != client.avatarId)
+                
+        for client, frames in clientFrames.items():
+            if frames:
+                self.sendUpdates(client, frames)
                 
-            # If we're interested OR owner, we send the update
-            if client.hasInterest(do.parentId, do.zoneId) or client.avatarId == do.doId:
-                client.sendMessage(CLIENT_OBJECT_UPDATE_FIELD, dg)
                 
+    def sendUpdates(self, client, frames):
+        """
+        Send framed updates to a client, dropping what can be dropped if it's slow
+        """
+        if client.writePaused:
+            kept = [frame for frame, droppable in frames if not droppable]
+            self.counters["droppedMessages"] += len(frames) - len(kept)
         
-    def handle(self, channels, sender, code, datagram):
+        else:
+            kept = [frame for frame, droppable in frames]
+        
+        if kept:
+            client.sendFrames(b"".join(kept))
+    
+    
+    def handle(self, channel, sender, code, datagram):
         """
         Handle a message
         """
-        for channel in channels:
-            for client in self.clients:
-                if client.avatarId is None:
-                    continue
+        # We're only registered to the puppet channels (avatarId + (1<<32))
+        client = self.avatarClients.get(channel - (1<<32))
+        if client is None:
+            return
+            
+        if code == STATESERVER_OBJECT_UPDATE_FIELD:
+            client.sendMessage(CLIENT_OBJECT_UPDATE_FIELD, datagram)
+            
+        else:
+            raise Exception("Unexpected message on Puppet channel (code %d)" % code)
                     
-                if channel == client.avatarId + (1<<32):
-                    if code == STATESERVER_OBJECT_UPDATE_FIELD:
-                        client.sendMessage(CLIENT_OBJECT_UPDATE_FIELD, datagram)
-                        
-                    else:
-                        raise Exception("Unexpected message on Puppet channel (code %d)" % code)
-                        
-                        
\ No newline at end of file
+                    
\ No newline at end of file
@@ -1,4 +1,5 @@
 from panda3d.direct import DCPacker
+from dc_layout import getLayout, REQUIRED, DB
 from pprint import pformat
 
 class DatabaseObject:
@@ -6,22 +7,21 @@ class DatabaseObject:
         self.dbss = dbss
         self.doId = doId
         self.dclass = dclass
+        self.layout = getLayout(dclass)
         self.fields = {}
         
         
     def packRequired(self, dg):
         packer = DCPacker()
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if field.isRequired():
-                packer.beginPack(field)
-                if field.getName() in self.fields:
-                    field.packArgs(packer, self.fields[field.getName()])
-                else:
-                    packer.packDefaultValue()
-                    
-                packer.endPack()
+        for number, name, field in self.layout.allRequired:
+            packer.beginPack(field)
+            if name in self.fields:
+                field.packArgs(packer, self.fields[name])
+            else:
+                packer.packDefaultValue()
                 
+            packer.endPack()
+            
         dg.appendData(packer.getBytes())
         
         
@@ -29,12 +29,11 @@ class DatabaseObject:
         packer = DCPacker()
         count = 0
         
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if field.isDb() and not field.isRequired() and field.getName() in self.fields:
-                packer.rawPackUint16(field.getNumber())
+        for number, name, field in self.layout.db:
+            if not self.layout.flags[number] & REQUIRED and name in self.fields:
+                packer.rawPackUint16(number)
                 packer.beginPack(field)
-                field.packArgs(packer, self.fields[field.getName()])
+                field.packArgs(packer, self.fields[name])
                 packer.packDefaultValue()
                 packer.endPack()
                 count += 1
@@ -120,6 +119,16 @@ class DatabaseObject:
         
         
     def receiveField(self, field, di):
+        self.readField(field, di)
+        
+        # This isn't very optimized, but we wanna make sure we don't lose anything
+        self.dbss.saveDatabaseObject(self)
+        
+        
+    def readField(self, field, di):
+        """
+        Apply a field update without saving
+        """
         packer = DCPacker()
         packer.setUnpackData(di.getRemainingBytes())
         
@@ -131,7 +140,7 @@ class DatabaseObject:
                 packer.beginUnpack(atomic)
                 value = atomic.unpackArgs(packer)
                 
-                if atomic.isDb():
+                if self.layout.flags[atomic.getNumber()] & DB:
                     self.fields[atomic.getName()] = value
                     
                 packer.endUnpack()
@@ -140,16 +149,13 @@ class DatabaseObject:
             packer.beginUnpack(field)
             value = field.unpackArgs(packer)
             
-            if field.isDb():
+            if self.layout.flags[field.getNumber()] & DB:
                 self.fields[field.getName()] = value
             
             packer.endUnpack()
             
         di.skipBytes(packer.getNumUnpackedBytes())
         
-        # This isn't very optimized, but we wanna make sure we don't lose anything
-        self.dbss.saveDatabaseObject(self)
-        
         
     def update(self, field, *values):
         # "Manual" update
@@ -21,55 +21,78 @@ class DatabaseServer:
         if not os.path.exists(self.path):
             os.mkdir(self.path)
             
+        # DBServer channel
+        self.otp.registerChannel(4003, self)
             
-    def handle(self, channels, sender, code, datagram):
+            
+    def handle(self, channel, sender, code, datagram):
         """
         Handle a message
         """
-        for channel in channels:
-            if channel == 4003:
-                if code == DBSERVER_GET_STORED_VALUES:
-                    print("DBSERVER_GET_STORED_VALUES")
-                    
-                elif code == DBSERVER_SET_STORED_VALUES:
-                    print("DBSERVER_SET_STORED_VALUES")
-                    
-                elif code == DBSERVER_CREATE_STORED_OBJECT:
-                    print("DBSERVER_CREATE_STORED_OBJECT")
-                    
-                elif code == DBSERVER_GET_ESTATE:
-                    print("DBSERVER_GET_ESTATE")
-                    
-                elif code == DBSERVER_MAKE_FRIENDS:
-                    print("DBSERVER_MAKE_FRIENDS")
-                    
-                elif code == DBSERVER_REQUEST_SECRET:
-                    print("DBSERVER_REQUEST_SECRET")
-                    
-                elif code == DBSERVER_SUBMIT_SECRET:
-                    print("DBSERVER_SUBMIT_SECRET")
-                    
-                else:
-                    raise Exception("Unknown message on DBServer channel: %d" % code)
-                    
-            if channel in self.cache:
-                di = DatagramIterator(datagram)
-                do = self.cache[channel]
+        if channel == 4003:
+            if code == DBSERVER_GET_STORED_VALUES:
+                print("DBSERVER_GET_STORED_VALUES")
+                
+            elif code == DBSERVER_SET_STORED_VALUES:
+                print("DBSERVER_SET_STORED_VALUES")
+                
+            elif code == DBSERVER_CREATE_STORED_OBJECT:
+                print("DBSERVER_CREATE_STORED_OBJECT")
+                
+            elif code == DBSERVER_GET_ESTATE:
+                print("DBSERVER_GET_ESTATE")
+                
+            elif code == DBSERVER_MAKE_FRIENDS:
+                print("DBSERVER_MAKE_FRIENDS")
+                
+            elif code == DBSERVER_REQUEST_SECRET:
+                print("DBSERVER_REQUEST_SECRET")
+                
+            elif code == DBSERVER_SUBMIT_SECRET:
+                print("DBSERVER_SUBMIT_SECRET")
                 
-                if code == STATESERVER_OBJECT_UPDATE_FIELD:
-                    # We are asked to update a field
-                    doId = di.getUint32()
+            else:
+                raise Exception("Unknown message on DBServer channel: %d" % code)
+                
+        if channel in self.cache:
+            di = DatagramIterator(datagram)
+            do = self.cache[channel]
+            
+            if code == STATESERVER_OBJECT_UPDATE_FIELD:
+                # We are asked to update a field
+                doId = di.getUint32()
+                fieldId = di.getUint16()
+                
+                # Is this sent to the correct object?
+                if doId != do.doId:
+                    raise Exception("Object %d does not match channel %d" % (doId, do.doId))
+                
+                # We apply the update
+                field = do.dclass.getFieldByIndex(fieldId)
+                do.receiveField(field, di)
+                
+            elif code == STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE:
+                # We are asked to update several fields at once
+                doId = di.getUint32()
+                count = di.getUint16()
+                
+                # Is this sent to the correct object?
+                if doId != do.doId:
+                    raise Exception("Object %d does not match channel %d" % (doId, do.doId))
+                
+                # We apply every update, and save once
+                for n in range(count):
                     fieldId = di.getUint16()
                     
-                    # Is this sent to the correct object?
-                    if doId != do.doId:
-                        raise Exception("Object %d does not match channel %d" % (doId, do.doId))
-                    
-                    # We apply the update
                     field = do.dclass.getFieldByIndex(fieldId)
-                    do.receiveField(field, di)
-                
-                
+                    if not field:
+                        raise Exception("Object %d has no field %d" % (doId, fieldId))
+                        
+                    do.readField(field, di)
+                    
+                self.saveDatabaseObject(do)
+            
+            
     def createDatabaseObject(self, dclassName):
         """
         Create a database object with the dclass and default fields
@@ -93,13 +116,11 @@ class DatabaseServer:
         
         # We set default values
         packer = DCPacker()
-        for n in range(dclass.getNumInheritedFields()):
-            field = dclass.getInheritedField(n)
-            if field.isDb():
-                packer.setUnpackData(field.getDefaultValue())
-                packer.beginUnpack(field)
-                do.fields[field.getName()] = field.unpackArgs(packer)
-                packer.endUnpack()
+        for number, name, field in do.layout.db:
+            packer.setUnpackData(field.getDefaultValue())
+            packer.beginUnpack(field)
+            do.fields[name] = field.unpackArgs(packer)
+            packer.endUnpack()
                 
         # We save the object
         self.saveDatabaseObject(do)
@@ -121,6 +142,9 @@ class DatabaseServer:
         if not doId in self.cache:
             with open(os.path.join(self.path, str(doId) + ".bin"), "rb") as file:
                 self.cache[doId] = DatabaseObject.fromBinary(self, file.read())
+                
+            # We receive the updates of the cached objects
+            self.otp.registerChannel(doId, self)
         
         return self.cache[doId]
         
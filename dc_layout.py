@@ -0,0 +1,122 @@
+"""
+Per dclass field tables, built once when the DC file is loaded.
+Going through the Panda3D bindings (getInheritedField, isRequired...) for
+every field of every object is slow, so we sort the fields once.
+"""
+
+# Field flags
+REQUIRED = 1 << 0
+BROADCAST = 1 << 1
+RAM = 1 << 2
+DB = 1 << 3
+CLSEND = 1 << 4
+OWNSEND = 1 << 5
+OWNRECV = 1 << 6
+AIRECV = 1 << 7
+ATOMIC = 1 << 8
+MOLECULAR = 1 << 9
+
+
+def getFlags(field):
+    flags = 0
+    for flag, test in ((REQUIRED, field.isRequired), (BROADCAST, field.isBroadcast), (RAM, field.isRam),
+                       (DB, field.isDb), (CLSEND, field.isClsend), (OWNSEND, field.isOwnsend),
+                       (OWNRECV, field.isOwnrecv), (AIRECV, field.isAirecv)):
+        if test():
+            flags |= flag
+
+    if field.asAtomicField():
+        flags |= ATOMIC
+
+    elif field.asMolecularField():
+        flags |= MOLECULAR
+
+    return flags
+
+
+class DCLayout:
+    """
+    Fields of a dclass, sorted by what we're doing with them.
+    Every table is a tuple of (number, name, field), in the dclass order.
+    """
+    def __init__(self, dclass):
+        self.dclass = dclass
+
+        # Field number -> flags
+        self.flags = {}
+
+        required = []
+        requiredBroadcast = []
+        allRequired = []
+        ram = []
+        db = []
+        other = []
+
+        for index in range(dclass.getNumInheritedFields()):
+            field = dclass.getInheritedField(index)
+            flags = getFlags(field)
+
+            entry = (field.getNumber(), field.getName(), field)
+            self.flags[entry[0]] = flags
+
+            if flags & REQUIRED:
+                allRequired.append(entry)
+
+                if flags & ATOMIC:
+                    required.append(entry)
+
+                    if flags & BROADCAST:
+                        requiredBroadcast.append(entry)
+
+            elif flags & BROADCAST:
+                other.append(entry)
+
+            if flags & (REQUIRED | RAM) and flags & ATOMIC:
+                ram.append(entry)
+
+            if flags & DB:
+                db.append(entry)
+
+        # Atomic required fields
+        self.required = tuple(required)
+
+        # Atomic required broadcast fields
+        self.requiredBroadcast = tuple(requiredBroadcast)
+
+        # Every required field (molecular and parameters too)
+        self.allRequired = tuple(allRequired)
+
+        # Atomic fields kept by the StateServer (required or RAM)
+        self.ram = tuple(ram)
+        self.ramNumbers = tuple(number for number, name, field in ram)
+
+        # Shared by every object of the dclass: the fields it keeps, all unset.
+        # Objects only store the fields which are set.
+        self.unset = dict.fromkeys(self.ramNumbers)
+
+        # Database fields
+        self.db = tuple(db)
+
+        # Broadcast fields which aren't required
+        self.other = tuple(other)
+
+
+# dclass number -> DCLayout
+layouts = {}
+
+
+def loadLayouts(dc):
+    """
+    Build the layouts of every dclass of a DC file
+    """
+    for n in range(dc.getNumClasses()):
+        dclass = dc.getClass(n)
+        layouts[dclass.getNumber()] = DCLayout(dclass)
+
+
+def getLayout(dclass):
+    number = dclass.getNumber()
+    if number not in layouts:
+        layouts[number] = DCLayout(dclass)
+
+    return layouts[number]
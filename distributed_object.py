@@ -1,8 +1,13 @@
 from panda3d.core import Datagram
 from panda3d.direct import DCPacker
+from dc_layout import getLayout, REQUIRED, BROADCAST
 
     
 class DistributedObject:
+    # We have a lot of objects, they don't need a __dict__
+    __slots__ = ("doId", "dclass", "parentId", "zoneId", "senderId", "layout", "fields",
+                 "requiredBlob", "requiredBroadcastBlob", "otherBlob")
+    
     def __init__(self, doId, dclass, parentId, zoneId):
         self.doId = doId
         self.dclass = dclass
@@ -11,111 +16,224 @@ class DistributedObject:
         
         self.senderId = None
         
+        # Fields tables of our dclass
+        self.layout = getLayout(dclass)
+        
+        # Field number -> packed bytes, only for the fields which are set.
+        # The fields we keep are in self.layout.unset.
         self.fields = {}
         
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if (field.isRequired() or field.isRam()) and field.asAtomicField():
-                self.fields[field.getNumber()] = None
-            
-            
-    def update(self, field, *values):
-        self.fields[self.dclass.getFieldByName(field).getNumber()] = values
+        # Packed REQUIRED, REQUIRED broadcast and OTHER fields, None until they're packed again
+        self.requiredBlob = None
+        self.requiredBroadcastBlob = None
+        self.otherBlob = None
+        
         
+    def update(self, field, *values):
+        field = self.dclass.getFieldByName(field)
+        number = field.getNumber()
         
-    def packField(self, dg, field):
         packer = DCPacker()
         packer.beginPack(field)
+        field.packArgs(packer, values)
+        packer.endPack()
         
-        if field.getNumber() in self.fields:
-            field.packArgs(packer, self.fields[field.getNumber()])
+        self.fields[number] = packer.getBytes()
+        self.invalidate(number)
+        
+        
+    def invalidate(self, number):
+        """
+        Forget the packed fields including this field
+        """
+        self.invalidateFlags(self.layout.flags[number])
+        
+        
+    def invalidateFlags(self, flags):
+        """
+        Forget the packed fields including fields with those flags
+        """
+        if flags & REQUIRED:
+            self.requiredBlob = None
+            if flags & BROADCAST:
+                self.requiredBroadcastBlob = None
+                
+        elif flags & BROADCAST:
+            self.otherBlob = None
             
-        else:
-            packer.packDefaultValue()
+        
+    def packField(self, dg, number, field):
+        data = self.fields.get(number, None)
+        if data is None:
+            data = field.getDefaultValue()
             
-        packer.endPack()
-        dg.appendData(packer.getBytes())
+        dg.appendData(data)
         
         
     def packRequired(self, dg):
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if field.isRequired() and field.asAtomicField():
-                self.packField(dg, field)
+        if self.requiredBlob is None:
+            blob = Datagram()
+            for number, name, field in self.layout.required:
+                self.packField(blob, number, field)
+                
+            self.requiredBlob = blob.getMessage()
+            
+        dg.appendData(self.requiredBlob)
         
         
     def packRequiredBroadcast(self, dg):
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if (field.isRequired() and field.isBroadcast()) and field.asAtomicField():
-                self.packField(dg, field)
+        if self.requiredBroadcastBlob is None:
+            blob = Datagram()
+            for number, name, field in self.layout.requiredBroadcast:
+                self.packField(blob, number, field)
+                
+            self.requiredBroadcastBlob = blob.getMessage()
+            
+        dg.appendData(self.requiredBroadcastBlob)
         
         
     def packOther(self, dg):
-        dg2 = Datagram()
-        count = 0
+        if self.otherBlob is None:
+            dg2 = Datagram()
+            count = 0
+            
+            for number, name, field in self.layout.other:
+                if self.fields.get(number, None) is not None:
+                    count += 1
+                    
+                    dg2.addUint16(number)
+                    self.packField(dg2, number, field)
+                    
+            blob = Datagram()
+            blob.addUint16(count)
+            blob.appendData(dg2.getMessage())
+            self.otherBlob = blob.getMessage()
+            
+        dg.appendData(self.otherBlob)
         
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if field.isBroadcast() and not field.isRequired() and self.fields.get(field.getNumber(), None) is not None:
-                count += 1
-                
-                dg2.addUint16(field.getNumber())
-                self.packField(dg2, field)
-                
-        dg.addUint16(count)
-        dg.appendData(dg2.getMessage())
         
+    def unpackBytes(self, packer, data, field):
+        """
+        Get the bytes of the next field, without unpacking its value
+        """
+        start = packer.getNumUnpackedBytes()
         
-    def receiveField(self, field, di):
-        packer = DCPacker()
-        packer.setUnpackData(di.getRemainingBytes())
+        packer.beginUnpack(field)
+        packer.unpackSkip()
+        if not packer.endUnpack():
+            raise Exception("Invalid data for field %s" % field.getName())
+            
+        return data[start:packer.getNumUnpackedBytes()]
+        
+        
+    def unpackValues(self, packer, data, field):
+        """
+        Read a field update from the packer (unpacking data) without applying it.
+        Returns the (number, bytes) of the atomic fields we're keeping.
+        """
+        values = []
         
         molecular = field.asMolecularField()
         if molecular:
             for n in range(molecular.getNumAtomics()):
                 atomic = molecular.getAtomic(n)
+                value = self.unpackBytes(packer, data, atomic)
                 
-                packer.beginUnpack(atomic)
-                value = atomic.unpackArgs(packer)
-                
-                if atomic.getNumber() in self.fields:
-                    self.fields[atomic.getNumber()] = value
+                number = atomic.getNumber()
+                if number in self.layout.unset:
+                    values.append((number, value))
                     
-                packer.endUnpack()
-                
         else:
-            packer.beginUnpack(field)
-            value = field.unpackArgs(packer)
+            value = self.unpackBytes(packer, data, field)
             
-            if field.getNumber() in self.fields:
-                self.fields[field.getNumber()] = value
+            number = field.getNumber()
+            if number in self.layout.unset:
+                values.append((number, value))
+                
+        return values
+        
+        
+    def unpackField(self, field, di):
+        """
+        Read a field update without applying it, see unpackValues
+        """
+        data = di.getRemainingBytes()
+        
+        packer = DCPacker()
+        packer.setUnpackData(data)
+        
+        values = self.unpackValues(packer, data, field)
+        
+        di.skipBytes(packer.getNumUnpackedBytes())
+        return values
+        
+        
+    def unpackFields(self, di):
+        """
+        Read a count of (field index, value) updates without applying them.
+        Returns the updates as (field, bytes), and the values to apply (see unpackValues).
+        """
+        # Like receiveRequired, every field is read with the same packer
+        data = di.getRemainingBytes()
+        
+        packer = DCPacker()
+        packer.setUnpackData(data)
+        
+        updates = []
+        values = []
+        
+        for n in range(packer.rawUnpackUint16()):
+            index = packer.rawUnpackUint16()
             
-            packer.endUnpack()
+            field = self.dclass.getFieldByIndex(index)
+            if not field:
+                raise Exception("Object %d has no field %d" % (self.doId, index))
+                
+            start = packer.getNumUnpackedBytes()
+            values.extend(self.unpackValues(packer, data, field))
+            updates.append((field, data[start:packer.getNumUnpackedBytes()]))
             
         di.skipBytes(packer.getNumUnpackedBytes())
+        return updates, values
+        
+        
+    def applyFields(self, values):
+        """
+        Apply fields read by unpackField, invalidating the packed fields once
+        """
+        kinds = set()
+        for number, value in values:
+            self.fields[number] = value
+            kinds.add(self.layout.flags[number] & (REQUIRED | BROADCAST))
+            
+        for flags in kinds:
+            self.invalidateFlags(flags)
+        
+        
+    def receiveField(self, field, di):
+        self.applyFields(self.unpackField(field, di))
         
         
     def receiveRequired(self, di):
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if field.isRequired() and field.asAtomicField():
-                self.receiveField(field, di)
+        # We're unpacking every field with the same packer,
+        # instead of copying the remaining data for each field
+        data = di.getRemainingBytes()
         
+        packer = DCPacker()
+        packer.setUnpackData(data)
         
-    def receiveRequiredBroadcast(self, di):
-        for index in range(self.dclass.getNumInheritedFields()):
-            field = self.dclass.getInheritedField(index)
-            if field.isRequired() or field.asAtomicField():
-                self.receiveField(field, di)
+        for number, name, field in self.layout.required:
+            self.fields[number] = self.unpackBytes(packer, data, field)
+            
+        di.skipBytes(packer.getNumUnpackedBytes())
+        
+        self.requiredBlob = None
+        self.requiredBroadcastBlob = None
         
         
     def receiveOther(self, di):
-        for n in range(di.getUint16()):
-            index = di.getUint16()
-            
-            field = self.dclass.getFieldByIndex(index)
-            self.receiveField(field, di)
+        updates, values = self.unpackFields(di)
+        self.applyFields(values)
             
             
     def __repr__(self):
@@ -0,0 +1,444 @@
+import collections
+import selectors
+import socket
+import heapq
+import itertools
+import time
+import ssl
+
+
+# Maximum number of buffers we give to sendmsg at once
+IOV_MAX = 1024
+
+
+class Timer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class EventLoop:
+    """
+    Blocking event loop built on selectors (epoll on Linux).
+    Sockets are registered with a callback that is called with (sock, mask)
+    when they are ready, and timers are kept in a heap.
+    Transports written to during an iteration are flushed at its end.
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+
+        # Timers heap. The counter keeps timers with the same deadline ordered.
+        self.timers = []
+        self.counter = itertools.count()
+
+        # Transports with pending outbound data, flushed once per iteration
+        self.pendingFlush = {}
+
+
+    def register(self, sock, events, callback):
+        self.selector.register(sock, events, callback)
+
+
+    def modify(self, sock, events, callback):
+        self.selector.modify(sock, events, callback)
+
+
+    def unregister(self, sock):
+        self.selector.unregister(sock)
+
+
+    def scheduleFlush(self, transport):
+        self.pendingFlush[transport] = None
+
+
+    def callLater(self, delay, callback, *args):
+        """
+        Call a function after delay seconds. Returns a Timer that can be cancelled.
+        """
+        timer = Timer(time.monotonic() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.when, next(self.counter), timer))
+        return timer
+
+
+    def callSoon(self, callback, *args):
+        return self.callLater(0, callback, *args)
+
+
+    def poll(self):
+        """
+        Block until a socket is ready or a timer expires, then dispatch
+        """
+        # We drop the cancelled timers on top of the heap
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+
+        # We block until the next timer (or forever if we don't have any)
+        timeout = None
+        if self.pendingFlush:
+            timeout = 0
+
+        elif self.timers:
+            timeout = max(0, self.timers[0][0] - time.monotonic())
+
+        for key, mask in self.selector.select(timeout):
+            # A previous callback may have unregistered this socket
+            current = self.selector.get_map().get(key.fd)
+            if current is not None and current.fileobj is key.fileobj:
+                current.data(key.fileobj, mask)
+
+        # We run every expired timer. Timers added while we're running
+        # them are run on the next iteration.
+        now = time.monotonic()
+        expired = []
+        while self.timers and self.timers[0][0] <= now:
+            expired.append(heapq.heappop(self.timers)[2])
+
+        for timer in expired:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+        # We send everything that was written during this iteration
+        while self.pendingFlush:
+            pending, self.pendingFlush = self.pendingFlush, {}
+            for transport in pending:
+                transport.flush()
+
+
+    def run(self):
+        while True:
+            self.poll()
+
+
+class SocketTransport:
+    """
+    Minimal transport (in the asyncio sense) for a socket registered in an EventLoop.
+    This allows protocols (MDClient, Client) to run either on EventLoop or on asyncio.
+
+    Writes are queued in an outbound buffer which is flushed once per loop iteration,
+    and we only listen for write events while data is pending.
+    """
+    def __init__(self, loop, sock, protocol):
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+
+        # Closing: we stop reading and send what's left. Closed: the socket is closed.
+        self.closing = False
+        self.closed = False
+
+        # Outbound buffer
+        self.buffers = collections.deque()
+        self.bufferSize = 0
+        self.retrying = False
+        self.events = selectors.EVENT_READ
+        self.reading = True
+
+        # Watermarks, the protocol is paused when the buffer goes above highWater
+        # and resumed when it's back to lowWater
+        self.highWater = 64 * 1024
+        self.lowWater = self.highWater // 4
+        self.writePaused = False
+
+        # SSL sockets are handshaking first, and the protocol is told
+        # about the connection once it's done (like asyncio does)
+        self.handshaking = isinstance(sock, ssl.SSLSocket)
+
+        # The protocol only learns about the connection being lost if it knew about it
+        self.connected = False
+
+        self.sock.setblocking(False)
+        self.loop.register(self.sock, self.events, self.onEvent)
+
+        if self.handshaking:
+            self.doHandshake()
+
+        else:
+            self.connected = True
+            self.protocol.connection_made(self)
+
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return self.sock.getpeername()
+
+        elif name == "socket":
+            return self.sock
+
+        return default
+
+
+    def get_write_buffer_size(self):
+        return self.bufferSize
+
+
+    def get_write_buffer_limits(self):
+        return (self.lowWater, self.highWater)
+
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+
+        if low is None:
+            low = high // 4
+
+        if not 0 <= low <= high:
+            raise ValueError("high (%r) must be >= low (%r) must be >= 0" % (high, low))
+
+        self.highWater = high
+        self.lowWater = low
+        self.updateWritePaused()
+
+
+    def updateWritePaused(self):
+        if not self.writePaused and self.bufferSize > self.highWater:
+            self.writePaused = True
+            self.protocol.pause_writing()
+
+        elif self.writePaused and self.bufferSize <= self.lowWater:
+            self.writePaused = False
+            self.protocol.resume_writing()
+
+
+    def is_closing(self):
+        return self.closing
+
+
+    def pause_reading(self):
+        self.reading = False
+        self.updateEvents()
+
+
+    def resume_reading(self):
+        self.reading = True
+        self.updateEvents()
+
+
+    def is_reading(self):
+        return self.reading
+
+
+    def write(self, data):
+        if self.closing or not data:
+            return
+
+        self.buffers.append(data)
+        self.bufferSize += len(data)
+        self.loop.scheduleFlush(self)
+        self.updateWritePaused()
+
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+
+    def close(self):
+        """
+        Close once the outbound buffer is sent, like asyncio
+        """
+        if self.closing:
+            return
+
+        self.closing = True
+        self.reading = False
+
+        if self.buffers and not self.handshaking:
+            self.flush()
+
+        else:
+            self.closeSocket()
+
+
+    def abort(self):
+        """
+        Close now, dropping the outbound buffer
+        """
+        if self.closed:
+            return
+
+        self.closing = True
+        self.buffers.clear()
+        self.bufferSize = 0
+        self.closeSocket()
+
+
+    def closeSocket(self):
+        self.closed = True
+
+        if self.events:
+            self.loop.unregister(self.sock)
+
+        self.sock.close()
+
+        # Like asyncio, the protocol learns about it on the next iteration
+        # (and not at all if the connection failed during the handshake)
+        if self.connected:
+            self.loop.callSoon(self.protocol.connection_lost, None)
+
+
+    def setEvents(self, events):
+        if self.closed or events == self.events:
+            return
+
+        # Selectors don't take an empty mask, so we're unregistering instead
+        if not events:
+            self.loop.unregister(self.sock)
+
+        elif not self.events:
+            self.loop.register(self.sock, events, self.onEvent)
+
+        else:
+            self.loop.modify(self.sock, events, self.onEvent)
+
+        self.events = events
+
+
+    def updateEvents(self):
+        """
+        Listen for reads unless reading is paused, and for writes while data is pending
+        """
+        events = 0
+        if self.reading:
+            events |= selectors.EVENT_READ
+
+        if self.buffers:
+            events |= selectors.EVENT_WRITE
+
+        self.setEvents(events)
+
+
+    def doHandshake(self):
+        try:
+            self.sock.do_handshake()
+
+        except ssl.SSLWantReadError:
+            self.setEvents(selectors.EVENT_READ)
+            return
+
+        except ssl.SSLWantWriteError:
+            self.setEvents(selectors.EVENT_READ | selectors.EVENT_WRITE)
+            return
+
+        except (socket.error, ssl.SSLError):
+            self.handshaking = False
+            self.abort()
+            return
+
+        self.handshaking = False
+        self.setEvents(selectors.EVENT_READ)
+        self.connected = True
+        self.protocol.connection_made(self)
+
+
+    def onEvent(self, sock, mask):
+        if self.handshaking:
+            self.doHandshake()
+            return
+
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+
+        if mask & selectors.EVENT_READ and self.reading and not self.closing:
+            self.onReadable()
+
+
+    def onReadable(self):
+        # We read in place into the protocol buffer (like asyncio.BufferedProtocol)
+        while True:
+            try:
+                nbytes = self.sock.recv_into(self.protocol.get_buffer(-1))
+
+            except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                # Nothing to read yet (SSL record is incomplete)
+                return
+
+            except (socket.error, ssl.SSLError):
+                nbytes = 0
+
+            if not nbytes:
+                self.abort()
+                return
+
+            self.protocol.buffer_updated(nbytes)
+
+            # SSL sockets may have decrypted data pending that won't wake up the selector
+            if self.closing or not self.reading or not (isinstance(self.sock, ssl.SSLSocket) and self.sock.pending()):
+                return
+
+
+    def flush(self):
+        """
+        Send as much of the outbound buffer as the socket accepts
+        """
+        if self.closed or self.handshaking:
+            return
+
+        try:
+            if isinstance(self.sock, ssl.SSLSocket):
+                self.flushSSL()
+
+            else:
+                self.flushPlain()
+
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # Socket buffer is full, we'll continue when it's writable
+            pass
+
+        except (socket.error, ssl.SSLError):
+            self.abort()
+            return
+
+        # We were only waiting for the buffer to be sent
+        if self.closing and not self.buffers:
+            self.closeSocket()
+            return
+
+        self.updateEvents()
+        self.updateWritePaused()
+
+
+    def flushPlain(self):
+        while self.buffers:
+            if hasattr(self.sock, "sendmsg"):
+                sent = self.sock.sendmsg(itertools.islice(self.buffers, IOV_MAX))
+
+            else:
+                # No sendmsg on Windows
+                sent = self.sock.send(b"".join(self.buffers))
+
+            self.bufferSize -= sent
+
+            # We pop what was sent, and keep the remaining of a partial write
+            while sent:
+                data = self.buffers[0]
+                if sent < len(data):
+                    self.buffers[0] = memoryview(data)[sent:]
+                    return
+
+                sent -= len(data)
+                self.buffers.popleft()
+
+
+    def flushSSL(self):
+        # SSL doesn't support sendmsg, so we're joining the buffers.
+        # If a write has to be retried, OpenSSL wants the same data again.
+        while self.buffers:
+            if len(self.buffers) > 1 and not self.retrying:
+                self.buffers = collections.deque([b"".join(self.buffers)])
+
+            self.retrying = True
+            self.sock.send(self.buffers[0])
+            self.retrying = False
+
+            self.bufferSize -= len(self.buffers.popleft())
@@ -0,0 +1,95 @@
+import struct
+
+
+class FrameError(Exception):
+    pass
+
+
+class FrameBuffer:
+    """
+    Inbound buffer splitting a stream into frames (uint16 length, then data).
+
+    Data is received in place (recv_into, or asyncio.BufferedProtocol.get_buffer)
+    and complete frames are handed out as memoryviews of the buffer, so they
+    are only valid until the next read.
+    """
+    def __init__(self, maxFrameSize=0xFFFF, maxBufferSize=1024 * 1024, initialSize=4096):
+        self.maxFrameSize = maxFrameSize
+        self.maxBufferSize = max(maxBufferSize, maxFrameSize + 2)
+
+        self.buffer = bytearray(initialSize)
+        self.view = memoryview(self.buffer)
+
+        # Unread data is buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+
+    def getBuffer(self):
+        """
+        Get a writable view of the free space, compacting or growing if needed
+        """
+        if self.end == len(self.buffer):
+            size = self.end - self.start
+
+            if self.start:
+                # We move what's left to the beginning (memoryview copies handle overlaps)
+                self.view[:size] = self.view[self.start:self.end]
+
+            else:
+                # Buffer is full of unread data
+                if len(self.buffer) >= self.maxBufferSize:
+                    raise FrameError("buffer limit of %d bytes reached" % self.maxBufferSize)
+
+                buffer = bytearray(min(len(self.buffer) * 2, self.maxBufferSize))
+                buffer[:size] = self.view[:size]
+
+                self.buffer = buffer
+                self.view = memoryview(self.buffer)
+
+            self.start = 0
+            self.end = size
+
+        return self.view[self.end:]
+
+
+    def bufferUpdated(self, nbytes):
+        self.end += nbytes
+
+
+    def getBufferedSize(self):
+        return self.end - self.start
+
+
+    def nextFrame(self):
+        """
+        Get the next complete frame, or None
+        """
+        if self.end - self.start < 2:
+            return None
+
+        length, = struct.unpack_from("<H", self.buffer, self.start)
+        if length > self.maxFrameSize:
+            raise FrameError("frame of %d bytes is bigger than %d bytes" % (length, self.maxFrameSize))
+
+        if self.end - self.start < length + 2:
+            return None
+
+        frame = self.view[self.start + 2:self.start + 2 + length]
+        self.start += length + 2
+
+        # Nothing left, we can write from the beginning again
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        return frame
+
+
+    def frames(self):
+        """
+        Iterate over the complete frames
+        """
+        frame = self.nextFrame()
+        while frame is not None:
+            yield frame
+            frame = self.nextFrame()
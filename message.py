@@ -0,0 +1,75 @@
+from panda3d.core import Datagram
+
+import struct
+
+
+# Header readers (channels, sender, code) by channel count, which is a byte
+HEADERS = [struct.Struct("<%dQQH" % count) for count in range(256)]
+
+# Most messages are sent to a single channel
+HEADER = HEADERS[1]
+
+
+class Message:
+    """
+    A message routed by the MessageDirector.
+
+    The payload is kept as it came (in the received frame, or the Datagram
+    of a local sender), and what each destination needs is only built once, when
+    it's first needed: the framed bytes for MD clients, a Datagram for local handlers.
+    A message made from a received frame is only valid until the next read.
+    """
+    __slots__ = ("channels", "sender", "code", "datagram", "frame", "data")
+
+    def __init__(self, channels, sender, code, datagram=None, frame=None):
+        self.channels = channels
+        self.sender = sender
+        self.code = code
+
+        self.datagram = datagram
+        self.frame = frame
+
+        # Frame with its length prefix, ready to be written
+        self.data = None
+
+
+    @classmethod
+    def fromFrame(cls, frame):
+        """
+        Make a message from a received frame (without copying it)
+        """
+        count = frame[0]
+        if count == 1:
+            channel, sender, code = HEADER.unpack_from(frame, 1)
+            return cls((channel,), sender, code, None, frame)
+
+        header = HEADERS[count].unpack_from(frame, 1)
+        return cls(header[:count], header[count], header[count + 1], None, frame)
+
+
+    def getData(self):
+        """
+        Get the length prefixed frame, for MD clients
+        """
+        if self.data is None:
+            if self.frame is not None:
+                self.data = struct.pack("<H", len(self.frame)) + self.frame
+
+            else:
+                payload = self.datagram.getMessage()
+                count = len(self.channels)
+                header = struct.pack("<HB%dQQH" % count, 11 + 8 * count + len(payload), count, *self.channels, self.sender, self.code)
+                self.data = header + payload
+
+        return self.data
+
+
+    def getDatagram(self):
+        """
+        Get the payload as a Datagram, for local handlers.
+        Handlers are sharing it, so they shouldn't modify it.
+        """
+        if self.datagram is None:
+            self.datagram = Datagram(bytes(self.frame[11 + 8 * len(self.channels):]))
+
+        return self.datagram
@@ -1,64 +1,261 @@
 from panda3d.core import Datagram, DatagramIterator
+from framing import FrameBuffer, FrameError
+from message import Message
 from msgtypes import *
 
+import asyncio
+import bisect
 import socket
 import struct
 
-class MDClient:
-    def __init__(self, md, sock, addr):
+
+# First channel of a frame, to tell control messages apart without reading the whole header
+CHANNEL = struct.Struct("<Q")
+
+
+class RangeIndex:
+    """
+    Channel ranges subscriptions.
+    Ranges are split into disjoint segments: bounds is sorted, and segments[i]
+    is the set of subscribers of every channel in [bounds[i], bounds[i+1]).
+    Looking up a channel is a binary search.
+    """
+    def __init__(self):
+        self.bounds = []
+        self.segments = []
+        
+        
+    def split(self, channel):
+        """
+        Make sure a segment starts at channel, and return its index
+        """
+        index = bisect.bisect_left(self.bounds, channel)
+        if index < len(self.bounds) and self.bounds[index] == channel:
+            return index
+            
+        self.bounds.insert(index, channel)
+        self.segments.insert(index, set(self.segments[index - 1]) if index else set())
+        return index
+        
+        
+    def merge(self, index):
+        """
+        Merge the segment at index with the previous one if they're the same
+        """
+        if 0 < index < len(self.bounds) and self.segments[index] == self.segments[index - 1]:
+            del self.bounds[index]
+            del self.segments[index]
+            
+            
+    def add(self, client, low, high):
+        start = self.split(low)
+        end = self.split(high + 1)
+        
+        for index in range(start, end):
+            self.segments[index].add(client)
+            
+        self.merge(end)
+        self.merge(start)
+        
+        
+    def remove(self, client, low, high):
+        start = self.split(low)
+        end = self.split(high + 1)
+        
+        for index in range(start, end):
+            self.segments[index].discard(client)
+            
+        self.merge(end)
+        self.merge(start)
+        
+        # We don't need leading empty segments
+        while self.segments and not self.segments[0]:
+            del self.bounds[0]
+            del self.segments[0]
+            
+            
+    def lookup(self, channel):
+        """
+        Get the subscribers of a channel
+        """
+        index = bisect.bisect_right(self.bounds, channel) - 1
+        if index < 0:
+            return frozenset()
+            
+        return self.segments[index]
+        
+        
+    def covered(self, low, high):
+        """
+        Get the ranges of channels between low and high having subscribers,
+        as a list of (low, high)
+        """
+        ranges = []
+        index = max(bisect.bisect_right(self.bounds, low) - 1, 0)
+        
+        while index < len(self.bounds) and self.bounds[index] <= high:
+            if self.segments[index]:
+                start = max(self.bounds[index], low)
+                end = high if index + 1 == len(self.bounds) else min(self.bounds[index + 1] - 1, high)
+                
+                if ranges and ranges[-1][1] + 1 == start:
+                    ranges[-1] = (ranges[-1][0], end)
+                    
+                else:
+                    ranges.append((start, end))
+                    
+            index += 1
+            
+        return ranges
+        
+        
+def subtractRange(ranges, low, high):
+    """
+    Remove [low, high] from a list of (low, high) ranges
+    """
+    result = []
+    for otherLow, otherHigh in ranges:
+        if otherHigh < low or high < otherLow:
+            result.append((otherLow, otherHigh))
+            continue
+            
+        if otherLow < low:
+            result.append((otherLow, low - 1))
+            
+        if high < otherHigh:
+            result.append((high + 1, otherHigh))
+            
+    return result
+
+class MDClient(asyncio.BufferedProtocol):
+    __slots__ = ("md", "transport", "addr", "otp", "frameBuffer", "deficit", "readingPaused",
+                 "connectionName", "connectionURL", "channels", "ranges", "postRemove")
+    
+    def __init__(self, md):
         self.md = md
-        self.sock = sock
-        self.addr = addr
+        self.transport = None
+        self.addr = None
         
         # Quick access to OTP
         self.otp = self.md.otp
         
-        self.buffer = bytearray()
+        # AIs can send big bursts, so we allow them a bigger buffer
+        self.frameBuffer = FrameBuffer(maxBufferSize=4 * 1024 * 1024)
+        
+        # Scheduling: bytes we can still route this turn, and whether we stopped reading
+        self.deficit = 0
+        self.readingPaused = False
         
         self.connectionName = ""
         self.connectionURL = ""
         self.channels = set()
+        self.ranges = []
         self.postRemove = []
         
         
-    def onLost(self):
-        for x in self.postRemove:
-            self.onDatagram(Datagram(x))
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        self.md.clients.append(self)
+        
+        
+    def get_buffer(self, sizehint):
+        return self.frameBuffer.getBuffer()
+        
+        
+    def buffer_updated(self, nbytes):
+        self.frameBuffer.bufferUpdated(nbytes)
+        
+        # Frames are routed by the MD scheduler, we're just queueing them
+        self.md.schedule(self)
+        
+        # We stop reading when we're too far behind
+        if not self.readingPaused and self.frameBuffer.getBufferedSize() > self.md.readHighWater:
+            self.readingPaused = True
+            self.transport.pause_reading()
             
             
-    def onData(self, data):
-        self.buffer += data
-        while len(self.buffer) >= 2:
-            length = struct.unpack("<H", self.buffer[:2])[0]
-            if len(self.buffer) < length+2:
-                break
+    def processFrames(self, deficit):
+        """
+        Route our queued frames until the deficit (in bytes) is spent.
+        Return what's left of it, or None if we don't have any frame left.
+        """
+        # Priority frames have their own budget every turn, then they count like the others
+        priority = self.md.priorityQuantum
+        
+        try:
+            while deficit > 0:
+                frame = self.frameBuffer.nextFrame()
+                if frame is None:
+                    return None
+                    
+                if priority > 0 and self.md.isPriority(frame):
+                    priority -= len(frame)
+                    
+                else:
+                    deficit -= len(frame)
+                    
+                self.onDatagram(frame)
                 
-            packet = self.buffer[2:length+2]
-            self.buffer = self.buffer[length+2:]
+        except FrameError as e:
+            print("Dropping MD connection %s: %s" % (self.connectionName, e))
+            self.transport.abort()
+            return None
+            
+        return deficit
         
-            self.onDatagram(Datagram(bytes(packet)))
+        
+    def connection_lost(self, exc):
+        # We route what we received before the connection was closed
+        self.md.unschedule(self)
+        self.processFrames(float("inf"))
+        
+        self.md.clients.remove(self)
+        
+        for channel in self.channels:
+            self.md.unsubscribe(self, channel)
             
+        ranges, self.ranges = self.ranges, []
+        for low, high in ranges:
+            self.md.removeRange(self, low, high)
             
-    def onDatagram(self, dg):
-        di = DatagramIterator(dg)
+        self.onLost()
         
-        count = di.getUint8()
         
-        channels = []
-        for _ in range(count):
-            channel = di.getUint64()
-            channels.append(channel)
-        
-        if count == 1 and channel == CONTROL_MESSAGE:
+    def onLost(self):
+        for x in self.postRemove:
+            self.onDatagram(memoryview(x))
+            
+            
+    def onDatagram(self, frame):
+        # The frame is a view of our buffer, so we're reading the header in place
+        if frame[0] == 1 and CHANNEL.unpack_from(frame, 1)[0] == CONTROL_MESSAGE:
+            dg = Datagram(bytes(frame[9:]))
+            di = DatagramIterator(dg)
             code = di.getUint16()
             
             if code == CONTROL_SET_CHANNEL:
                 channel = di.getUint64()
                 self.channels.add(channel)
+                self.md.subscribe(self, channel)
                 
             elif code == CONTROL_REMOVE_CHANNEL:
                 channel = di.getUint64()
                 self.channels.remove(channel)
+                self.md.unsubscribe(self, channel)
+                
+            elif code == CONTROL_ADD_RANGE:
+                low = di.getUint64()
+                high = di.getUint64()
+                self.ranges.append((low, high))
+                self.md.addRange(self, low, high)
+                
+            elif code == CONTROL_REMOVE_RANGE:
+                low = di.getUint64()
+                high = di.getUint64()
+                # Like the index, we only keep what's left of our ranges
+                self.ranges = subtractRange(self.ranges, low, high)
+                self.md.removeRange(self, low, high)
                 
             elif code == CONTROL_ADD_POST_REMOVE:
                 message = di.getBlob()
@@ -73,66 +270,283 @@ class MDClient:
             else:
                 raise NotImplementedError("CONTROL_MESSAGE", code)
             
-            print(self.connectionName, self.connectionURL, self.channels)
+            print(self.connectionName, self.connectionURL, self.channels, self.ranges)
             
         else:
-            sender = di.getUint64()            
-            code = di.getUint16()
+            # We only read the header, the payload stays in our buffer
+            self.md.routeMessage(Message.fromFrame(frame), self)
             
-            for client in self.md.clients:
-                # We're not sending back our messages
-                if client == self:
-                    continue
-                    
-                if client.channels.intersection(channels):
-                    client.sendDatagram(dg)
-                
-            # We send this message to OTP
-            self.otp.handleMessage(channels, sender, code, Datagram(di.getRemainingBytes()))
+            
+    def sendMessage(self, message):
+        self.transport.write(message.getData())
+        
+        
+class MDUpstream(MDClient):
+    """
+    Our connection to an upstream MD.
+    We're one of its clients: we subscribe to every channel needed here, and
+    it sends us the messages for them. Everything sent here goes upstream too.
+    """
+    __slots__ = ()
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        
+        self.sendControl(CONTROL_SET_CON_NAME, name="PyOTP MD %d" % self.md.port)
+        
+        for channel in self.md.upstreamChannels:
+            self.sendControl(CONTROL_SET_CHANNEL, channel)
+            
+        for low, high in self.md.ranges.covered(0, (1 << 64) - 1):
+            self.sendControl(CONTROL_ADD_RANGE, low, high)
                 
+        self.md.upstream = self
+        print("Connected to upstream MD", self.addr)
+        
+        
+    def connection_lost(self, exc):
+        self.md.unschedule(self)
+        self.processFrames(float("inf"))
+        
+        print("Lost upstream MD", self.addr)
+        self.md.upstream = None
+        self.md.otp.onUpstreamLost()
+        
+        
+    def sendControl(self, code, *channels, name=None):
+        dg = Datagram()
+        dg.addUint8(1)
+        dg.addUint64(CONTROL_MESSAGE)
+        dg.addUint16(code)
+        for channel in channels:
+            dg.addUint64(channel)
             
-    def sendDatagram(self, dg):
-        self.sock.send(struct.pack("<H", dg.getLength()))
-        self.sock.send(bytes(dg))
+        if name is not None:
+            dg.addString(name)
+            
+        self.transport.writelines((struct.pack("<H", dg.getLength()), bytes(dg)))
         
         
 class MessageDirector:
-    def __init__(self, otp):
+    def __init__(self, otp, port=6666, upstream=None):
         # Main OTP
         self.otp = otp
         
-        # MD Sock
-        self.sock = socket.socket()
-        self.sock.bind(("0.0.0.0", 6666))
-        self.sock.listen(5)
+        # MD Sock, once we're listening
+        self.port = port
+        self.sock = None
+        
+        # Upstream MD (host, port), and its connection once we're connected
+        self.upstreamAddress = upstream
+        self.upstream = None
+        
+        # Channels we're subscribed to upstream
+        self.upstreamChannels = set()
         
         # MD Clients
         self.clients = []
         
+        # Channel to subscribed MD clients index
+        self.subscribers = {}
         
-    def sendMessage(self, channels, sender, code, datagram):
+        # Channel ranges subscriptions
+        self.ranges = RangeIndex()
+        
+        # Every message goes upstream, unless sharedChannels is set: then a message
+        # only sent to channels subscribed here, none of them shared, stays here.
+        # StateServer partitions keep the traffic of their objects to themselves.
+        self.sharedChannels = None
+        
+        # Fair scheduling between MD clients (deficit round robin).
+        # Every turn, each client with queued frames can route quantum bytes of frames.
+        # Frames only sent to priorityChannels (CONTROL messages) are first routed out of
+        # another priorityQuantum bytes, so a client flooding them can't starve the others.
+        # We stop reading a client above readHighWater bytes queued, and start again below readLowWater.
+        self.quantum = 16 * 1024
+        self.priorityChannels = {CONTROL_MESSAGE}
+        self.priorityQuantum = 4 * 1024
+        self.readHighWater = 1024 * 1024
+        self.readLowWater = 256 * 1024
+        
+        # Clients with queued frames (dict used as an ordered set)
+        self.active = {}
+        self.scheduled = False
+        
+        
+    def listen(self):
         """
-        Send a message to MD
+        Open our listening socket
         """
-        # We generate the message
-        dg = Datagram()
-        dg.addUint8(len(channels))
+        self.sock = socket.socket()
+        self.sock.bind(("0.0.0.0", self.port))
+        self.sock.listen(5)
+        
+        
+    def schedule(self, client):
+        """
+        Queue a client with frames to route
+        """
+        self.active[client] = None
+        
+        if not self.scheduled:
+            self.scheduled = True
+            self.otp.callLater(0, self.runScheduler)
+            
+            
+    def unschedule(self, client):
+        self.active.pop(client, None)
+        client.deficit = 0
+        
+        
+    def isPriority(self, frame):
+        return frame[0] == 1 and CHANNEL.unpack_from(frame, 1)[0] in self.priorityChannels
+        
+        
+    def runScheduler(self):
+        """
+        Do one turn: every client with queued frames routes up to quantum bytes.
+        We're running again on the next loop iteration (after reading sockets) if frames are left.
+        """
+        self.scheduled = False
+        
+        for client in list(self.active):
+            # A previous client may have closed this one
+            if client not in self.active:
+                continue
+                
+            deficit = client.processFrames(client.deficit + self.quantum)
+            if deficit is None:
+                # Nothing left, idle clients don't keep their credit
+                self.unschedule(client)
+                
+            else:
+                client.deficit = deficit
+                
+            if client.readingPaused and client.frameBuffer.getBufferedSize() <= self.readLowWater and not client.transport.is_closing():
+                client.readingPaused = False
+                client.transport.resume_reading()
+                
+        if self.active and not self.scheduled:
+            self.scheduled = True
+            self.otp.callLater(0, self.runScheduler)
+            
+            
+    def subscribe(self, client, channel):
+        if channel in self.subscribers:
+            self.subscribers[channel].add(client)
+            
+        else:
+            self.subscribers[channel] = {client}
+            self.updateUpstream(channel)
+            
+            
+    def unsubscribe(self, client, channel):
+        clients = self.subscribers.get(channel)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del self.subscribers[channel]
+                self.updateUpstream(channel)
+                
+                
+    def addRange(self, client, low, high):
+        self.ranges.add(client, low, high)
+        
+        if self.upstream is not None:
+            self.upstream.sendControl(CONTROL_ADD_RANGE, low, high)
+            
+            
+    def removeRange(self, client, low, high):
+        self.ranges.remove(client, low, high)
+        
+        if self.upstream is not None:
+            # Upstream only knows about us, so we're adding back what is still subscribed
+            self.upstream.sendControl(CONTROL_REMOVE_RANGE, low, high)
+            for otherLow, otherHigh in self.ranges.covered(low, high):
+                self.upstream.sendControl(CONTROL_ADD_RANGE, otherLow, otherHigh)
+                        
+                        
+    def updateUpstream(self, channel):
+        """
+        Subscribe to a channel upstream when it's first needed here (by a MD client
+        or by a local handler), and unsubscribe when it's not needed anymore
+        """
+        if self.upstreamAddress is None:
+            return
+            
+        needed = channel in self.subscribers or channel in self.otp.channelOwners
+        
+        if needed and channel not in self.upstreamChannels:
+            self.upstreamChannels.add(channel)
+            if self.upstream is not None:
+                self.upstream.sendControl(CONTROL_SET_CHANNEL, channel)
+                
+        elif not needed and channel in self.upstreamChannels:
+            self.upstreamChannels.remove(channel)
+            if self.upstream is not None:
+                self.upstream.sendControl(CONTROL_REMOVE_CHANNEL, channel)
+                
+                
+    def getSubscribers(self, channels):
+        """
+        Get every MD client subscribed to at least one of these channels
+        """
+        # Most messages have a single channel, we don't need to copy its subscribers
+        if len(channels) == 1 and not self.ranges.bounds:
+            return self.subscribers.get(channels[0], ())
+            
+        clients = set()
         for channel in channels:
-            dg.addUint64(channel)
+            if channel in self.subscribers:
+                clients |= self.subscribers[channel]
+                
+            if self.ranges.bounds:
+                clients |= self.ranges.lookup(channel)
+                
+        return clients
+        
+        
+    def isLocal(self, channels):
+        """
+        Check if a message stays here (see sharedChannels)
+        """
+        if self.sharedChannels is None:
+            return False
             
-        dg.addUint64(sender)
-        dg.addUint16(code)
-        dg.appendData(datagram.getMessage())
+        for channel in channels:
+            if channel in self.sharedChannels:
+                return False
+                
+            if channel not in self.subscribers and channel not in self.otp.channelOwners and not self.ranges.lookup(channel):
+                return False
+                
+        return True
+        
+        
+    def routeMessage(self, message, origin=None):
+        """
+        Send a message to the listening MD clients (except the one it comes from),
+        to the upstream MD (unless it comes from there) and to OTP
+        """
+        for client in self.getSubscribers(message.channels):
+            if client is not origin:
+                client.sendMessage(message)
+                
+        # We don't know who's listening upstream, it does
+        if self.upstream is not None and origin is not self.upstream and not self.isLocal(message.channels):
+            self.upstream.sendMessage(message)
+            
+        self.otp.handleMessage(message)
         
-        # We send the message to any listening
-        for client in self.clients:
-            if client.channels.intersection(channels):
-                client.sendDatagram(dg)
         
-        # Now we send this message to OTP
+    def sendMessage(self, channels, sender, code, datagram):
+        """
+        Send a message to MD
+        """
         # Please note we technically shouldn't transmit
         # to the handlers their own messages, but in this case
         # they know what they're doing. We'll fix this later. TODO
-        self.otp.handleMessage(channels, sender, code, datagram)
+        self.routeMessage(Message(channels, sender, code, datagram))
+        
         
-        
\ No newline at end of file
@@ -124,6 +124,10 @@ CLIENT_LOGIN_2_PLAY_TOKEN = 2  # VR Studio PlayToken.
 CLIENT_LOGIN_2_BLUE = 3        # The international GoReg token.
 CLIENT_LOGIN_3_DISL_TOKEN = 4  # SSL encoded blob from DISL system.
 
+# CLIENT_GO_GET_LOST reasons
+CLIENT_GO_GET_LOST_SLOW_CONSUMER = 1     # Shown as "an unexpected problem has occurred".
+CLIENT_GO_GET_LOST_DISTRICT_RESET = 153
+
 # DBSERVER messages
 DBSERVER_MAKE_FRIENDS = 1017
 DBSERVER_MAKE_FRIENDS_RESP = 1031
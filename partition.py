@@ -0,0 +1,385 @@
+"""
+StateServer partitions.
+
+With partitions, the StateServer runs in worker processes, each one having
+the objects with doId % count == index. Every partition has its own
+MessageDirector, connected to the main one as a downstream MD: what is sent
+there to its objects, or from them to the AIs connected there, stays there
+(MessageDirector.sharedChannels). AIs connect to the MD of the partition
+having their objects, so their updates never go through the main process.
+
+What every partition needs goes through the main MD: the generates on
+20100000 (the other partitions remember who owns the new object, for
+parents), the shard rests, and the deletes (PARTITIONS_CHANNEL).
+
+The main process keeps the ClientAgent, which needs to look at objects: the
+partitions send what they're announcing to game clients to MIRROR_CHANNEL,
+and the main process keeps a copy of the objects (StateServerMirror) from it.
+"""
+from panda3d.core import Datagram, DatagramIterator
+from state_server import StateServer
+from distributed_object import DistributedObject
+from dc_layout import OWNRECV, BROADCAST
+from msgtypes import *
+
+import subprocess
+import atexit
+import sys
+
+
+# Channel of the mirror, in the main process
+MIRROR_CHANNEL = 20100001
+
+# Every partition gets the deletes of the others on this channel
+PARTITIONS_CHANNEL = 20100002
+
+# Partition index is subscribing to PARTITION_CHANNELS + index,
+# so the main process knows which MD connection it is
+PARTITION_CHANNELS = 3 << 32
+
+
+class StateServerPartition(StateServer):
+    """
+    StateServer with the objects of one partition.
+    It also knows the owner of the objects of the other partitions, which
+    may be the parents of its objects (getInterested, SET_ZONE, shard rest).
+    """
+    def __init__(self, otp, index, count):
+        self.index = index
+        self.count = count
+
+        # Owners of the objects of other partitions (doId -> senderId),
+        # and their objects by owner (senderId -> set of doIds)
+        self.owners = {}
+        self.ownerObjects = {}
+
+        StateServer.__init__(self, otp)
+
+        # We send the main process what it must announce to game clients
+        self.clientAgent = RemoteClientAgent(otp)
+
+        # Every partition gets what's sent to the StateServer, and the deletes
+        self.otp.registerChannel(20100000, self)
+        self.otp.registerChannel(PARTITIONS_CHANNEL, self)
+        self.otp.registerChannel(PARTITION_CHANNELS + index, self)
+        self.messageDirector.sharedChannels = {20100000, PARTITIONS_CHANNEL}
+
+
+    def owns(self, doId):
+        return doId % self.count == self.index
+
+
+    def hasObject(self, doId):
+        return doId in self.objects or doId in self.owners
+
+
+    def getOwner(self, doId):
+        if doId in self.objects:
+            return self.objects[doId].senderId
+
+        return self.owners[doId]
+
+
+    def addOwner(self, doId, owner):
+        """
+        Remember the owner of an object of another partition
+        """
+        self.removeOwner(doId)
+        self.owners[doId] = owner
+        self.ownerObjects.setdefault(owner, set()).add(doId)
+
+
+    def removeOwner(self, doId):
+        owner = self.owners.pop(doId, None)
+        if owner is None:
+            return
+
+        doIds = self.ownerObjects[owner]
+        doIds.discard(doId)
+        if not doIds:
+            del self.ownerObjects[owner]
+
+
+    def getShardObjects(self, shardId):
+        objects = StateServer.getShardObjects(self, shardId)
+
+        # Objects of this shard in other partitions may be the parents of ours.
+        # Their partitions are deleting them, we're forgetting them now.
+        for doId in self.ownerObjects.pop(shardId, ()):
+            del self.owners[doId]
+            objects.update(self.children.get(doId, {}))
+
+        return objects
+
+
+    def isForPartition(self, sender, code, datagram):
+        """
+        Every partition gets what's sent to the StateServer channel:
+        check if it's about an object of our partition
+        """
+        di = DatagramIterator(datagram)
+
+        if code in (STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED_OTHER):
+            di.skipBytes(10)
+            doId = di.getUint32()
+            if self.owns(doId):
+                return True
+
+            # We remember who owns it, in case it's the parent of one of ours
+            self.addOwner(doId, sender)
+            return False
+
+        elif code == STATESERVER_OBJECT_DELETE_RAM:
+            return self.owns(di.getUint32())
+
+        elif code == STATESERVER_SHARD_REST:
+            # Every partition deletes its objects of the shard
+            return True
+
+        elif code == STATESERVER_QUERY_ZONE_OBJECT_ALL:
+            # The main process answers, it has every object
+            return False
+
+        # It's for the ObjectServer itself
+        return self.owns(20100000)
+
+
+    def handle(self, channel, sender, code, datagram):
+        if channel == PARTITIONS_CHANNEL:
+            if code != STATESERVER_OBJECT_DELETE_RAM:
+                raise NotImplementedError("Received %d on partitions channel" % code)
+
+            # Objects deleted by a partition (we're getting ours too)
+            di = DatagramIterator(datagram)
+            while di.getRemainingSize():
+                self.removeOwner(di.getUint32())
+
+            return
+
+        if channel == PARTITION_CHANNELS + self.index:
+            return
+
+        if channel == 20100000 and not self.isForPartition(sender, code, datagram):
+            return
+
+        StateServer.handle(self, channel, sender, code, datagram)
+
+
+class RemoteClientAgent:
+    """
+    ClientAgent of a partition: sends what would be announced to game clients
+    to the main process, with the original sender.
+    """
+    def __init__(self, otp):
+        self.otp = otp
+        self.messageDirector = otp.messageDirector
+
+
+    def send(self, sender, code, dg, channels=(MIRROR_CHANNEL,)):
+        self.messageDirector.sendMessage(list(channels), sender, code, dg)
+
+
+    def isVisible(self, do, number):
+        """
+        Game clients only see the broadcast and ownrecv fields
+        """
+        return do.layout.flags.get(number, 0) & (OWNRECV | BROADCAST)
+
+
+    def announceCreate(self, do, sender):
+        dg = Datagram()
+        dg.addUint32(do.parentId)
+        dg.addUint32(do.zoneId)
+        dg.addUint16(do.dclass.getNumber())
+        dg.addUint32(do.doId)
+        do.packRequired(dg)
+        do.packOther(dg)
+
+        self.send(sender, STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER, dg)
+
+
+    def announceDelete(self, do, sender):
+        self.announceDeleteMany([do], sender)
+
+
+    def announceDeleteMany(self, objects, sender):
+        dg = Datagram()
+        for do in objects:
+            dg.addUint32(do.doId)
+
+        # The other partitions forget their owners too
+        if dg.getLength():
+            self.send(sender, STATESERVER_OBJECT_DELETE_RAM, dg, (MIRROR_CHANNEL, PARTITIONS_CHANNEL))
+
+
+    def announceMove(self, do, prevParentId, prevZoneId, sender):
+        dg = Datagram()
+        dg.addUint32(do.doId)
+        dg.addUint32(do.parentId)
+        dg.addUint32(do.zoneId)
+
+        self.send(sender, STATESERVER_OBJECT_SET_ZONE, dg)
+
+
+    def announceUpdate(self, do, field, data, sender):
+        if not self.isVisible(do, field.getNumber()):
+            return
+
+        dg = Datagram()
+        dg.addUint32(do.doId)
+        dg.addUint16(field.getNumber())
+        dg.appendData(data)
+
+        self.send(sender, STATESERVER_OBJECT_UPDATE_FIELD, dg)
+
+
+    def announceUpdates(self, do, updates, sender):
+        updates = [(field, data) for field, data in updates if self.isVisible(do, field.getNumber())]
+        if updates:
+            self.send(sender, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE, self.otp.stateServer.packUpdates(do, updates))
+
+
+class StateServerMirror(StateServer):
+    """
+    Copy of the objects of every partition, for the ClientAgent.
+    It doesn't own any object channel and doesn't send anything to AIs,
+    it's only applying what the partitions tell it and announcing it to game clients.
+    It also answers zone queries, as it's the only one with every object.
+    """
+    def __init__(self, otp, count):
+        # How many partitions we have
+        self.count = count
+
+        StateServer.__init__(self, otp)
+
+        self.otp.registerChannel(MIRROR_CHANNEL, self)
+        self.otp.registerChannel(20100000, self)
+
+
+    def addObject(self, do):
+        # The object channel belongs to a partition
+        self.objects[do.doId] = do
+        self.addToIndex(self.senderObjects, do.senderId, do)
+        self.addToZone(do)
+
+
+    def removeObject(self, do, sender):
+        del self.objects[do.doId]
+        self.removeFromIndex(self.senderObjects, do.senderId, do)
+        self.removeFromZone(do)
+
+
+    def subscribePartition(self, doId):
+        """
+        Subscribe the partition of a new object to its channel now.
+        It's subscribing by itself once it has the object, but what's sent
+        to the object through us before that (like a move right after a generate)
+        would be lost.
+        """
+        for client in list(self.messageDirector.subscribers.get(PARTITION_CHANNELS + doId % self.count, ())):
+            client.channels.add(doId)
+            self.messageDirector.subscribe(client, doId)
+
+
+    def handle(self, channel, sender, code, datagram):
+        di = DatagramIterator(datagram)
+
+        if channel == 20100000:
+            # The partitions are handling everything else
+            if code in (STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED_OTHER):
+                di.skipBytes(10)
+                self.subscribePartition(di.getUint32())
+
+            elif code == STATESERVER_QUERY_ZONE_OBJECT_ALL:
+                context = di.getUint32()
+                parentId = di.getUint32()
+                zones = [di.getUint32() for n in range(di.getUint16())]
+
+                locations = {(parentId, zoneId) for zoneId in zones}
+                self.sendZoneObjects(sender, context, locations, self.getZoneObjects(parentId, zones), 0)
+
+            return
+
+        if code == STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER:
+            parentId = di.getUint32()
+            zoneId = di.getUint32()
+            classId = di.getUint16()
+            doId = di.getUint32()
+
+            do = DistributedObject(doId, self.dc.getClass(classId), parentId, zoneId)
+            do.senderId = sender
+            do.receiveRequired(di)
+            do.receiveOther(di)
+
+            # A generate of an object we already have replaces it
+            if doId in self.objects:
+                self.removeObject(self.objects[doId], sender)
+
+            self.addObject(do)
+            self.clientAgent.announceCreate(do, sender)
+
+        elif code == STATESERVER_OBJECT_DELETE_RAM:
+            objects = []
+            while di.getRemainingSize():
+                doId = di.getUint32()
+                if doId in self.objects:
+                    objects.append(self.objects[doId])
+                    self.removeObject(self.objects[doId], sender)
+
+            if len(objects) == 1:
+                self.clientAgent.announceDelete(objects[0], sender)
+
+            elif objects:
+                self.clientAgent.announceDeleteMany(objects, sender)
+
+        elif code == STATESERVER_OBJECT_SET_ZONE:
+            do = self.objects.get(di.getUint32())
+            parentId = di.getUint32()
+            zoneId = di.getUint32()
+
+            if do is not None:
+                prevParentId, prevZoneId = do.parentId, do.zoneId
+                self.moveObject(do, parentId, zoneId)
+                self.clientAgent.announceMove(do, prevParentId, prevZoneId, sender)
+
+        elif code == STATESERVER_OBJECT_UPDATE_FIELD:
+            do = self.objects.get(di.getUint32())
+            fieldId = di.getUint16()
+            data = di.getRemainingBytes()
+
+            if do is not None:
+                field = do.dclass.getFieldByIndex(fieldId)
+                do.receiveField(field, di)
+                self.clientAgent.announceUpdate(do, field, data, sender)
+
+        elif code == STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE:
+            do = self.objects.get(di.getUint32())
+            if do is None:
+                return
+
+            updates, values = do.unpackFields(di)
+            do.applyFields(values)
+            self.clientAgent.announceUpdates(do, updates, sender)
+
+        else:
+            raise NotImplementedError("Received %d on mirror channel" % code)
+
+
+def spawnPartitions(count, mdPort, partitionPort, options=()):
+    """
+    Start count StateServer partitions, their MDs listening from partitionPort
+    and connected to our MessageDirector
+    """
+    processes = []
+    for index in range(count):
+        args = [sys.executable, sys.argv[0], "--partition", "%d/%d" % (index, count),
+                "--md-port", str(partitionPort + index), "--upstream", "127.0.0.1:%d" % mdPort]
+        processes.append(subprocess.Popen(args + list(options)))
+
+    # They're going down with us
+    def stop():
+        for process in processes:
+            process.terminate()
+
+    atexit.register(stop)
+    return processes
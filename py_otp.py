@@ -1,85 +1,240 @@
 from panda3d.core import Filename
 from panda3d.direct import DCFile
+from dc_layout import loadLayouts
 
-from message_director import MessageDirector, MDClient
+from message_director import MessageDirector, MDClient, MDUpstream
 from state_server import StateServer
 from client_agent import ClientAgent
 from client import Client
 from database_server import DatabaseServer
+from snapshot import SnapshotWriter, restoreSnapshot
+from partition import StateServerPartition, StateServerMirror, spawnPartitions
 
+from event_loop import EventLoop, SocketTransport
+
+import argparse
+import asyncio
+import selectors
 import socket
-import select
+import time
+import os
 
 class PyOTP:
-    def __init__(self):
-        # Every socket client (makes the code faster)
-        self.clients = {}
-        
+    def __init__(self, mdOnly=False, mdPort=6666, upstream=None, listen=True, partition=None, partitions=0):
         # DC File
         self.dc = DCFile()
         self.dc.read(Filename("etc", "otp.dc"))
         self.dc.read(Filename("etc", "toon.dc"))
+        loadLayouts(self.dc)
+        
+        # Channel ownership: every handler registers the channels it handles
+        self.channelOwners = {}
+        
+        # "Handlers". A MD only node is routing messages for other nodes.
+        self.messageDirector = MessageDirector(self, mdPort, upstream)
+        self.clientAgent = None
+        self.stateServer = None
+        self.databaseServer = None
+        
+        if partition:
+            # We're a StateServer partition (index, count) behind our own MD
+            self.stateServer = StateServerPartition(self, *partition)
+            
+        elif not mdOnly:
+            # With partitions, we only have a copy of the objects for the ClientAgent
+            self.clientAgent = ClientAgent(self)
+            self.stateServer = StateServerMirror(self, partitions) if partitions else StateServer(self)
+            self.databaseServer = DatabaseServer(self)
+            
+        # Sockets and game data, only needed to serve clients
+        if listen:
+            self.messageDirector.listen()
+            if self.clientAgent:
+                self.clientAgent.listen()
+                self.clientAgent.loadDNA()
+                
+        # Event loop, which we use for listening sockets, clients and timers
+        self.setupLoop()
         
-        # "Handlers"
-        self.messageDirector = MessageDirector(self)
-        self.clientAgent = ClientAgent(self)
-        self.stateServer = StateServer(self)
-        self.databaseServer = DatabaseServer(self)
         
+    def setupLoop(self):
+        self.loop = EventLoop()
+        if self.messageDirector.sock:
+            self.loop.register(self.messageDirector.sock, selectors.EVENT_READ, self.onAccept)
+            
+        if self.clientAgent and self.clientAgent.sock:
+            self.loop.register(self.clientAgent.sock, selectors.EVENT_READ, self.onAccept)
+            
+        if self.messageDirector.upstreamAddress:
+            sock = socket.create_connection(self.messageDirector.upstreamAddress)
+            SocketTransport(self.loop, sock, MDUpstream(self.messageDirector))
+            
         
-    def handleMessage(self, channels, sender, code, datagram):
+    def callLater(self, delay, callback, *args):
         """
-        Transmit a received message from MD to SS, CA and DBSS
+        Call a function after delay seconds
         """
-        self.stateServer.handle(channels, sender, code, datagram)
-        self.clientAgent.handle(channels, sender, code, datagram)
-        self.databaseServer.handle(channels, sender, code, datagram)
+        return self.loop.callLater(delay, callback, *args)
         
         
-    def flush(self):
+    def onUpstreamLost(self):
+        """
+        A partition is useless without the main process
+        """
+        if isinstance(self.stateServer, StateServerPartition):
+            raise SystemExit("Lost the main process")
+            
+            
+    def registerChannel(self, channel, handler):
         """
-        Do some socket magic
+        Make a handler (SS, CA or DBSS) receive the messages sent to a channel
         """
-        # TODO: use socketserver or something different.
-        # We are very limited by select here
-        
-        r, w, x = select.select([self.messageDirector.sock, self.clientAgent.sock] + list(self.clients), [], [], 0)
-        for sock in r:
-            if sock == self.messageDirector.sock:
-                sock, addr = sock.accept()
-                self.clients[sock] = MDClient(self.messageDirector, sock, addr)
-                self.messageDirector.clients.append(self.clients[sock])
+        if channel in self.channelOwners:
+            if handler not in self.channelOwners[channel]:
+                self.channelOwners[channel] = self.channelOwners[channel] + (handler,)
                 
-            elif sock == self.clientAgent.sock:
-                sock, addr = sock.accept()
-                self.clients[sock] = Client(self.clientAgent, sock, addr)
-                self.clientAgent.clients.append(self.clients[sock])
+        else:
+            self.channelOwners[channel] = (handler,)
+            self.messageDirector.updateUpstream(channel)
+            
+            
+    def unregisterChannel(self, channel, handler):
+        handlers = self.channelOwners.get(channel, ())
+        if handler in handlers:
+            handlers = tuple(owner for owner in handlers if owner != handler)
+            if handlers:
+                self.channelOwners[channel] = handlers
                 
             else:
-                client = self.clients[sock]
-                try:
-                    data = sock.recv(2048)
-                except socket.error:
-                    data = None
-                    
-                if not data:
-                    del self.clients[sock]
-                    
-                    if type(client) == MDClient:
-                        self.messageDirector.clients.remove(client)
-                        
-                    elif type(client) == Client:
-                        self.clientAgent.clients.remove(client)
-                    
-                    client.onLost()
-                    
-                else:
-                    client.onData(data)
-                    
-                    
+                del self.channelOwners[channel]
+                self.messageDirector.updateUpstream(channel)
+                
+                
+    def getChannelOwners(self, channel):
+        return self.channelOwners.get(channel, ())
+        
+        
+    def handleMessage(self, message):
+        """
+        Transmit a received message from MD to the SS, CA or DBSS owning its channels
+        """
+        for channel in message.channels:
+            for handler in self.channelOwners.get(channel, ()):
+                handler.handle(channel, message.sender, message.code, message.getDatagram())
+                
+                
+    def flush(self):
+        """
+        Do some socket magic.
+        This blocks until a socket is ready or a timer expires.
+        """
+        self.loop.poll()
+        
+        
+    def run(self):
+        while True:
+            self.flush()
+            
+            
+    def onAccept(self, listener, mask):
+        """
+        Accept a new MD or CA connection
+        """
+        sock, addr = listener.accept()
+        
+        if listener == self.messageDirector.sock:
+            SocketTransport(self.loop, sock, MDClient(self.messageDirector))
+            
+        else:
+            # The transport is doing the handshake without blocking the loop
+            sock.setblocking(False)
+            sock = self.clientAgent.sslContext.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+            SocketTransport(self.loop, sock, Client(self.clientAgent))
+            
+            
+class AsyncPyOTP(PyOTP):
+    """
+    PyOTP running on asyncio: MDClient and Client are asyncio protocols
+    fed by the MessageDirector and ClientAgent servers.
+    """
+    def setupLoop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        
+        
+    def callLater(self, delay, callback, *args):
+        return self.loop.call_later(delay, callback, *args)
+        
+        
+    async def serve(self):
+        if self.messageDirector.upstreamAddress:
+            host, port = self.messageDirector.upstreamAddress
+            await self.loop.create_connection(lambda: MDUpstream(self.messageDirector), host, port)
+            
+        servers = [await self.loop.create_server(lambda: MDClient(self.messageDirector), sock=self.messageDirector.sock)]
+        if self.clientAgent:
+            servers.append(await self.loop.create_server(lambda: Client(self.clientAgent), sock=self.clientAgent.sock, ssl=self.clientAgent.sslContext))
+            
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+        
+        
+    def run(self):
+        self.loop.run_until_complete(self.serve())
+        
+        
 
 if __name__ == "__main__":
-    otp = PyOTP()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--asyncio", action="store_true", help="run on asyncio instead of the selectors loop")
+    parser.add_argument("--md-port", type=int, default=6666, help="port of the MessageDirector")
+    parser.add_argument("--upstream", metavar="HOST:PORT", help="connect the MessageDirector to an upstream MD")
+    parser.add_argument("--md-only", action="store_true", help="only run a MessageDirector (use with --upstream to spread AIs)")
+    parser.add_argument("--snapshot", metavar="FILE", help="snapshot the StateServer objects to this file")
+    parser.add_argument("--snapshot-interval", type=float, default=60.0, help="seconds between snapshots")
+    parser.add_argument("--restore", action="store_true", help="restore the StateServer objects from the snapshot")
+    parser.add_argument("--partitions", type=int, default=0, help="run the StateServer in this many processes, each one behind its own MD")
+    parser.add_argument("--partition-port", type=int, default=6670, help="port of the MD of the first partition (the next ones follow)")
+    parser.add_argument("--partition", metavar="INDEX/COUNT", help="run a StateServer partition (started by --partitions)")
+    parser.add_argument("--smooth-tick", metavar="MS", type=float, help="send smooth node updates to clients every MS milliseconds, only the latest of each field")
+    args = parser.parse_args()
     
-    while True:
-        otp.flush()
\ No newline at end of file
+    partition = None
+    if args.partition:
+        index, count = args.partition.split("/")
+        partition = (int(index), int(count))
+        
+        if not args.upstream:
+            parser.error("a partition needs --upstream")
+            
+    if (args.partitions or args.partition) and (args.snapshot or args.md_only):
+        parser.error("partitions can't be used with --snapshot or --md-only")
+        
+    if (args.snapshot or args.restore) and args.md_only:
+        parser.error("a MD only node has no StateServer to snapshot")
+        
+    if args.restore and not args.snapshot:
+        parser.error("--restore needs --snapshot")
+    
+    upstream = None
+    if args.upstream:
+        host, port = args.upstream.rsplit(":", 1)
+        upstream = (host, int(port))
+        
+    cls = AsyncPyOTP if args.asyncio else PyOTP
+    otp = cls(mdOnly=args.md_only, mdPort=args.md_port, upstream=upstream, partition=partition, partitions=args.partitions)
+    
+    if args.partitions:
+        spawnPartitions(args.partitions, args.md_port, args.partition_port, ["--asyncio"] if args.asyncio else [])
+        
+    if args.smooth_tick and otp.clientAgent:
+        otp.clientAgent.smoothTick = args.smooth_tick / 1000
+        
+    if args.restore and os.path.exists(args.snapshot):
+        start = time.perf_counter()
+        count = restoreSnapshot(otp.stateServer, args.snapshot)
+        print("Restored %d objects from %s in %.2f s" % (count, args.snapshot, time.perf_counter() - start))
+        
+    if args.snapshot:
+        SnapshotWriter(otp.stateServer, args.snapshot, args.snapshot_interval).start()
+        
+    otp.run()
@@ -0,0 +1,161 @@
+"""
+StateServer snapshots, so a restart doesn't lose the RAM objects.
+
+A snapshot is a header (magic, DC hash) followed by one record per object:
+doId, dclass number, parentId, zoneId and senderId, the length of every RAM
+field of the dclass (UNSET if it's not set), then the packed fields.
+Fields are in the order of the dclass layout, which is why the DC hash must match.
+"""
+from distributed_object import DistributedObject
+from dc_layout import getLayout
+
+import itertools
+import threading
+import queue
+import struct
+import time
+import os
+
+
+MAGIC = b"PYOTPSS\x01"
+HEADER = struct.Struct("<8sI")
+RECORD = struct.Struct("<IHIIQ")
+
+# Length of a field which isn't set
+UNSET = 0xFFFF
+
+
+def packObject(do):
+    values = [do.fields.get(number) for number in do.layout.ramNumbers]
+    lengths = [UNSET if value is None else len(value) for value in values]
+
+    header = RECORD.pack(do.doId, do.dclass.getNumber(), do.parentId, do.zoneId, do.senderId or 0)
+    return header + struct.pack("<%dH" % len(lengths), *lengths) + b"".join(value for value in values if value is not None)
+
+
+class SnapshotWriter:
+    """
+    Write the StateServer objects to a file every interval seconds.
+
+    Objects are packed a batch at a time, leaving the loop between batches,
+    and a background thread writes them (the file is only replaced once complete).
+    Objects changing while we're packing end up in the snapshot as they were
+    when their batch was packed.
+    """
+    def __init__(self, stateServer, path, interval=60.0):
+        self.stateServer = stateServer
+        self.otp = stateServer.otp
+        self.path = path
+        self.interval = interval
+
+        # How many objects we pack in a loop iteration
+        self.batchSize = 250
+
+        # Packed data for the writer thread. None ends a snapshot.
+        self.queue = queue.Queue()
+
+        # How long writing the last snapshot took (packing included)
+        self.lastDuration = None
+
+        self.thread = threading.Thread(target=self.writeSnapshots, daemon=True)
+        self.thread.start()
+
+
+    def start(self):
+        self.otp.callLater(self.interval, self.takeSnapshot)
+
+
+    def takeSnapshot(self):
+        """
+        Start a snapshot of every object we have now
+        """
+        objects = list(self.stateServer.objects.values())
+        self.queue.put(HEADER.pack(MAGIC, self.stateServer.dc.getHash()))
+        self.packObjects(objects, 0)
+
+
+    def packObjects(self, objects, start):
+        end = start + self.batchSize
+
+        # The object may have been deleted since the snapshot started
+        data = [packObject(do) for do in objects[start:end] if self.stateServer.objects.get(do.doId) is do]
+        self.queue.put(b"".join(data))
+
+        if end < len(objects):
+            self.otp.callLater(0, self.packObjects, objects, end)
+
+        else:
+            self.queue.put(None)
+            self.otp.callLater(self.interval, self.takeSnapshot)
+
+
+    def writeSnapshots(self):
+        """
+        Writer thread
+        """
+        file = None
+        while True:
+            data = self.queue.get()
+            if file is None:
+                file = open(self.path + ".tmp", "wb")
+                started = time.monotonic()
+
+            if data is not None:
+                file.write(data)
+                continue
+
+            # We only replace the previous snapshot with a complete one
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+            file = None
+
+            os.replace(self.path + ".tmp", self.path)
+            self.lastDuration = time.monotonic() - started
+
+
+def restoreSnapshot(stateServer, path):
+    """
+    Add the objects of a snapshot to the StateServer.
+    Objects the StateServer already has (its own objects) are kept.
+    Returns how many objects were restored.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+
+    magic, dcHash = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise Exception("%s is not a snapshot" % path)
+
+    if dcHash != stateServer.dc.getHash():
+        raise Exception("%s was taken with another DC file" % path)
+
+    offset = HEADER.size
+    count = 0
+
+    while offset < len(data):
+        doId, classId, parentId, zoneId, senderId = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+
+        dclass = stateServer.dc.getClass(classId)
+        numbers = getLayout(dclass).ramNumbers
+
+        lengths = struct.unpack_from("<%dH" % len(numbers), data, offset)
+        offset += 2 * len(numbers)
+
+        # Where every field starts and ends
+        offsets = list(itertools.accumulate([0 if length == UNSET else length for length in lengths], initial=offset))
+        values = [None if length == UNSET else data[start:end] for length, start, end in zip(lengths, offsets, offsets[1:])]
+        offset = offsets[-1]
+
+        if doId in stateServer.objects:
+            continue
+
+        do = DistributedObject(doId, dclass, parentId, zoneId)
+        do.senderId = senderId or None
+        do.fields = {number: value for number, value in zip(numbers, values) if value is not None}
+
+        stateServer.addObject(do)
+        count += 1
+
+    return count
@@ -1,5 +1,6 @@
 from panda3d.core import Datagram, DatagramIterator
 from distributed_object import DistributedObject
+from dc_layout import AIRECV
 from msgtypes import *
 import time
 
@@ -18,16 +19,104 @@ class StateServer:
         # Distributed Objects
         self.objects = {}
         
-        # We add the StateServer Object
-        self.objects[20100000] = DistributedObject(20100000, self.dc.getClassByName("ObjectServer"), 0, 0)
-        self.objects[20100000].update("setName", "PyOTP")
-        self.objects[20100000].update("setDcHash", 798635679)
-        self.objects[20100000].update("setDateCreated", int(time.time()))
+        # Location index: (parentId, zoneId) -> {doId: object}
+        self.zones = {}
+        
+        # Owner index (senderId -> {doId: object}) and parent index (parentId -> {doId: object})
+        self.senderObjects = {}
+        self.children = {}
+        
+        # How many objects we send at once when answering a zone query
+        self.queryBatchSize = 100
         
+        # We add the StateServer Object
+        if self.owns(20100000):
+            self.addObject(DistributedObject(20100000, self.dc.getClassByName("ObjectServer"), 0, 0))
+            self.objects[20100000].update("setName", "PyOTP")
+            self.objects[20100000].update("setDcHash", 798635679)
+            self.objects[20100000].update("setDateCreated", int(time.time()))
+            
         # CentralLogger
-        self.objects[4688] = DistributedObject(4688, self.dc.getClassByName("CentralLogger"), 0, 0)
+        if self.owns(4688):
+            self.addObject(DistributedObject(4688, self.dc.getClassByName("CentralLogger"), 0, 0))
+        
+        
+        
+        
+    def owns(self, doId):
+        """
+        Check if an object is ours to handle (a partition only has some of them)
+        """
+        return True
+        
+        
+    def hasObject(self, doId):
+        """
+        Check if an object exists (a partition also knows the objects of the others)
+        """
+        return doId in self.objects
+        
+        
+    def getOwner(self, doId):
+        """
+        Get the channel which generated an object
+        """
+        return self.objects[doId].senderId
+        
+        
+    def addObject(self, do):
+        """
+        Add an object, we're now handling its channel
+        """
+        self.objects[do.doId] = do
+        self.otp.registerChannel(do.doId, self)
+        self.addToIndex(self.senderObjects, do.senderId, do)
+        self.addToZone(do)
         
         
+    def addToIndex(self, index, key, do):
+        if key in index:
+            index[key][do.doId] = do
+            
+        else:
+            index[key] = {do.doId: do}
+            
+            
+    def removeFromIndex(self, index, key, do):
+        objects = index[key]
+        del objects[do.doId]
+        if not objects:
+            del index[key]
+            
+            
+    def addToZone(self, do):
+        self.addToIndex(self.zones, (do.parentId, do.zoneId), do)
+        self.addToIndex(self.children, do.parentId, do)
+        
+        
+    def removeFromZone(self, do):
+        self.removeFromIndex(self.zones, (do.parentId, do.zoneId), do)
+        self.removeFromIndex(self.children, do.parentId, do)
+        
+            
+    def moveObject(self, do, parentId, zoneId):
+        self.removeFromZone(do)
+        do.parentId = parentId
+        do.zoneId = zoneId
+        self.addToZone(do)
+        
+        
+    def getZoneObjects(self, parentId, zones):
+        """
+        Get the objects in these zones of a parent
+        """
+        objects = []
+        for zoneId in zones:
+            location = (parentId, zoneId)
+            if location in self.zones:
+                objects.extend(self.zones[location].values())
+                
+        return objects
         
         
     def getInterested(self, do, sender):
@@ -40,8 +129,8 @@ class StateServer:
         if do.senderId:
             channels.add(do.senderId)
         
-        if do.parentId in self.objects:
-            channels.add(self.objects[do.parentId].senderId)
+        if self.hasObject(do.parentId):
+            channels.add(self.getOwner(do.parentId))
         
         if sender in channels:
             channels.remove(sender)
@@ -49,205 +138,262 @@ class StateServer:
         return list(channels)
         
         
-    def deleteObject(self, do, sender):
+    def getShardObjects(self, shardId):
         """
-        Delete an object and transmits the deletion
+        Get the objects created by a shard, and every object parented to them
+        """
+        objects = dict(self.senderObjects.get(shardId, {}))
+        for parentId in list(objects):
+            objects.update(self.children.get(parentId, {}))
+            
+        return objects
+        
+        
+    def sendZoneObjects(self, channel, context, locations, objects, start):
+        """
+        Answer a STATESERVER_QUERY_ZONE_OBJECT_ALL for these (parentId, zoneId) locations:
+        send a batch of objects (one STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER each),
+        and leave the loop before the next one. The DONE message ends the answer.
+        """
+        end = start + self.queryBatchSize
+        for do in objects[start:end]:
+            # The object may have been deleted or moved away since the query
+            if self.objects.get(do.doId) is not do or (do.parentId, do.zoneId) not in locations:
+                continue
+                
+            dg = Datagram()
+            dg.addUint32(do.parentId)
+            dg.addUint32(do.zoneId)
+            dg.addUint16(do.dclass.getNumber())
+            dg.addUint32(do.doId)
+            do.packRequired(dg)
+            do.packOther(dg)
+            
+            self.messageDirector.sendMessage([channel], 20100000, STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER, dg)
+            
+        if end < len(objects):
+            self.otp.callLater(0, self.sendZoneObjects, channel, context, locations, objects, end)
+            
+        else:
+            dg = Datagram()
+            dg.addUint32(context)
+            self.messageDirector.sendMessage([channel], 20100000, STATESERVER_QUERY_ZONE_OBJECT_ALL_DONE, dg)
+            
+            
+    def packUpdates(self, do, updates):
+        """
+        Pack a STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE from (field, data) updates
+        """
+        dg = Datagram()
+        dg.addUint32(do.doId)
+        dg.addUint16(len(updates))
+        
+        for field, data in updates:
+            dg.addUint16(field.getNumber())
+            dg.appendData(data)
+        
+        return dg
+    
+    
+    def removeObject(self, do, sender):
+        """
+        Remove an object and transmits the deletion to OTP clients
         """
         assert self.objects[do.doId] == do, "wrong object"
         
         # We can delete the object
         del self.objects[do.doId]
+        self.otp.unregisterChannel(do.doId, self)
+        self.removeFromIndex(self.senderObjects, do.senderId, do)
+        self.removeFromZone(do)
         
         # We should tell everyone the object is gone
         # Write the delete ram packet
         dg = Datagram()
         dg.addUint32(do.doId)
         
-        # We send the update to the interested OTP clients
+        # We send the update to the interested OTP clients,
+        # and to whoever asked for it (unless we're deleting it ourselves)
         channels = self.getInterested(do, sender)
-        channels.append(sender)
+        if sender != 20100000:
+            channels.append(sender)
+            
         if channels:
             self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_DELETE_RAM, dg)
+            
+            
+    def deleteObject(self, do, sender):
+        """
+        Delete an object and transmits the deletion
+        """
+        self.removeObject(do, sender)
         
         # We announce to game clients too (through ClientAgent)
         self.clientAgent.announceDelete(do, sender)
         
         
-    def handle(self, channels, sender, code, datagram):
+    def handle(self, channel, sender, code, datagram):
         """
         Handle a message
         """
-        for channel in channels:
-            # There's an object with ID 20100000 : it's the ObjectServer.
-            # That's why we need to check for object channels first
-            if channel in self.objects:
-                di = DatagramIterator(datagram)
-                do = self.objects[channel]
+        # There's an object with ID 20100000 : it's the ObjectServer.
+        # That's why we need to check for object channels first
+        # (with partitions, only one of them has the ObjectServer)
+        if channel in self.objects or channel == 20100000:
+            di = DatagramIterator(datagram)
+            do = self.objects.get(channel)
+            
+            if code == STATESERVER_QUERY_OBJECT_ALL:
+                # Someone is asking info about us
+                context = di.getUint32()
                 
-                if code == STATESERVER_QUERY_OBJECT_ALL:
-                    # Someone is asking info about us
-                    context = di.getUint32()
-                    
-                    # We're sending our REQUIRED and OTHER fields
-                    dg = Datagram()
-                    dg.addUint32(context)
-                    dg.addUint32(do.parentId)
-                    dg.addUint32(do.zoneId)
-                    dg.addUint16(do.dclass.getNumber())
-                    dg.addUint32(do.doId)
-                    do.packRequired(dg)
-                    do.packOther(dg) # TODO Should we check for airecv?
-                    
-                    self.messageDirector.sendMessage([sender], 20100000, STATESERVER_QUERY_OBJECT_ALL_RESP, dg)
-                    
+                # We're sending our REQUIRED and OTHER fields
+                dg = Datagram()
+                dg.addUint32(context)
+                dg.addUint32(do.parentId)
+                dg.addUint32(do.zoneId)
+                dg.addUint16(do.dclass.getNumber())
+                dg.addUint32(do.doId)
+                do.packRequired(dg)
+                do.packOther(dg) # TODO Should we check for airecv?
+                
+                self.messageDirector.sendMessage([sender], 20100000, STATESERVER_QUERY_OBJECT_ALL_RESP, dg)
+                
+                
+            elif code == STATESERVER_OBJECT_UPDATE_FIELD:
+                # We are asked to update a field
+                doId = di.getUint32()
+                fieldId = di.getUint16()
+                
+                # Is this sent to the correct object?
+                if doId != do.doId:
+                    raise Exception("Object %d does not match channel %d" % (doId, do.doId))
                     
-                elif code == STATESERVER_OBJECT_UPDATE_FIELD:
-                    # We are asked to update a field
-                    doId = di.getUint32()
-                    fieldId = di.getUint16()
+                # The remaining data is field data
+                data = di.getRemainingBytes()
+                
+                # We apply the update
+                do = self.objects[doId]
+                
+                field = do.dclass.getFieldByIndex(fieldId)
+                do.receiveField(field, di)
+                
+                # We transmit the update if it was not sent by the owner
+                channels = self.getInterested(do, sender)
+                
+                # We did not implement airecv fields yet so let's do it.
+                if not do.layout.flags.get(fieldId, 0) & AIRECV and do.senderId in channels:
+                    channels.remove(do.senderId)
                     
-                    # Is this sent to the correct object?
-                    if doId != do.doId:
-                        raise Exception("Object %d does not match channel %d" % (doId, do.doId))
-                        
-                    # The remaining data is field data
-                    data = di.getRemainingBytes()
+                if channels:
+                    dg = Datagram()
+                    dg.addUint32(doId)
+                    dg.addUint16(fieldId)
+                    dg.appendData(data)
                     
-                    # We apply the update
-                    do = self.objects[doId]
+                    self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_UPDATE_FIELD, dg)
                     
-                    field = do.dclass.getFieldByIndex(fieldId)
-                    do.receiveField(field, di)
+                # We announce to clients too (cause we're a ClientAgent)
+                self.clientAgent.announceUpdate(do, field, data, sender)
+            
+            
+            elif code == STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE:
+                # We are asked to update several fields at once
+                doId = di.getUint32()
+                
+                # Is this sent to the correct object?
+                if doId != do.doId:
+                    raise Exception("Object %d does not match channel %d" % (doId, do.doId))
+                
+                # We read every field before applying anything, so a bad
+                # field doesn't leave the object half updated
+                updates, values = do.unpackFields(di)
+                do.applyFields(values)
+                
+                # We transmit the update once to every interested channel.
+                # The owner only gets the airecv fields.
+                channels = self.getInterested(do, sender)
+                
+                if do.senderId in channels:
+                    channels.remove(do.senderId)
                     
-                    # We transmit the update if it was not sent by the owner
-                    channels = self.getInterested(do, sender)
+                    airecv = [(field, data) for field, data in updates if do.layout.flags.get(field.getNumber(), 0) & AIRECV]
+                    if airecv:
+                        self.messageDirector.sendMessage([do.senderId], sender, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE, self.packUpdates(do, airecv))
+                
+                if channels:
+                    self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE, self.packUpdates(do, updates))
+                
+                # We announce to clients too (cause we're a ClientAgent)
+                self.clientAgent.announceUpdates(do, updates, sender)
+            
+            
+            elif code == STATESERVER_OBJECT_DELETE_RAM:
+                # We are asked to delete an object.
+                
+                # This packet can be sent to the StateServer (20100000)
+                # or the object channel.
+                
+                # We must check if doId matches, and if it doesn't,
+                # it means it was sent to the wrong channel or to the SS channel.
+                
+                doId = di.getUint32()
+                if do is not None and do.doId == doId:
+                    # It was sent directly to the object, which means it was found
+                    self.deleteObject(do, sender)
                     
-                    # We did not implement airecv fields yet so let's do it.
-                    if not field.isAirecv() and do.senderId in channels:
-                        channels.remove(do.senderId)
+                elif channel == 20100000: # Same as checking do.doId
+                    if doId in self.objects:
+                        # It was sent to the state server,
+                        # which means the state server handles the deletion of the object
+                        self.deleteObject(self.objects[doId], 20100000)
                         
-                    if channels:
+                    else:
+                        # We answer it was not found
                         dg = Datagram()
                         dg.addUint32(doId)
-                        dg.addUint16(fieldId)
-                        dg.appendData(data)
-                        
-                        self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_UPDATE_FIELD, dg)
+                        self.messageDirector.sendMessage([sender], 20100000, STATESERVER_OBJECT_NOTFOUND, dg)
                         
-                    # We announce to clients too (cause we're a ClientAgent)
-                    self.clientAgent.announceUpdate(do, field, data, sender)
-                    
-                        
-                elif code == STATESERVER_OBJECT_DELETE_RAM:
-                    # We are asked to delete an object.
-                    
-                    # This packet can be sent to the StateServer (20100000)
-                    # or the object channel.
+                else:
+                    raise Exception("Received invalid delete object message (channel %d doId %d)" % (channel, doId))
                     
-                    # We must check if doId matches, and if it doesn't,
-                    # it means it was sent to the wrong channel or to the SS channel.
                     
-                    doId = di.getUint32()
-                    if do.doId == doId:
-                        # It was sent directly to the object, which means it was found
-                        self.deleteObject(do, sender)
-                        
-                    elif channel == 20100000: # Same as checking do.doId
-                        if doId in self.objects:
-                            # It was sent to the state server,
-                            # which means the state server handles the deletion of the object
-                            self.deleteObject(self.objects[doId], 20100000)
-                            
-                        else:
-                            # We answer it was not found
+            elif code == STATESERVER_OBJECT_SET_ZONE:
+                # We are asked to move an object.
+                parentId = di.getUint32()
+                zoneId = di.getUint32()
+                
+                # We get the previous zone
+                prevParentChannel = self.getOwner(do.parentId) if self.hasObject(do.parentId) else None
+                prevParentId, prevZoneId = do.parentId, do.zoneId
+                
+                # We set the new zone
+                self.moveObject(do, parentId, zoneId)
+                
+                # We announce the object was moved if it was not asked by the "owner"
+                if self.hasObject(do.parentId) and sender != self.getOwner(do.parentId):
+                    if prevParentId == do.parentId:
+                        # Parent id is the same: just send the update to the old a new zone
+                        channels = self.getInterested(do, sender)
+                        if channels:
                             dg = Datagram()
-                            dg.addUint32(doId)
-                            self.messageDirector.sendMessage([sender], 20100000, STATESERVER_OBJECT_NOTFOUND, dg)
+                            dg.addUint32(do.doId)
+                            dg.addUint32(do.parentId)
+                            dg.addUint32(do.zoneId)
+                            dg.addUint32(prevParentId)
+                            dg.addUint32(prevZoneId)
                             
-                    else:
-                        raise Exception("Received invalid delete object message (channel %d doId %d)" % (channel, doId))
-                        
+                            self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_CHANGE_ZONE, dg)
                         
-                elif code == STATESERVER_OBJECT_SET_ZONE:
-                    # We are asked to move an object.
-                    parentId = di.getUint32()
-                    zoneId = di.getUint32()
-                    
-                    # We get the previous zone
-                    prevParentChannel = self.objects[do.parentId].senderId if do.parentId in self.objects else None
-                    prevParentId, prevZoneId = do.parentId, do.zoneId
-                    
-                    # We set the new zone
-                    do.parentId = parentId
-                    do.zoneId = zoneId
-                    
-                    # We announce the object was moved if it was not asked by the "owner"
-                    if do.parentId in self.objects and sender != self.objects[do.parentId].senderId:
-                        if prevParentId == do.parentId:
-                            # Parent id is the same: just send the update to the old a new zone
-                            channels = self.getInterested(do, sender)
-                            if channels:
-                                dg = Datagram()
-                                dg.addUint32(do.doId)
-                                dg.addUint32(do.parentId)
-                                dg.addUint32(do.zoneId)
-                                dg.addUint32(prevParentId)
-                                dg.addUint32(prevZoneId)
-                                
-                                self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_CHANGE_ZONE, dg)
-                            
-                        else:
-                            # Parent id changed: we must remove it and add it back
-                            if prevParentChannel:
-                                dg = Datagram()
-                                dg.addUint32(do.doId)
-                                
-                                self.messageDirector.sendMessage([prevParentChannel], sender, STATESERVER_OBJECT_LEAVING_AI_INTEREST, dg)
+                    else:
+                        # Parent id changed: we must remove it and add it back
+                        if prevParentChannel:
+                            dg = Datagram()
+                            dg.addUint32(do.doId)
                             
-                            channels = self.getInterested(do, sender)
-                            if channels:
-                                dg = Datagram()
-                                dg.addUint32(do.parentId)
-                                dg.addUint32(do.zoneId)
-                                dg.addUint16(do.dclass.getNumber())
-                                dg.addUint32(do.doId)
-                                do.packRequired(dg)
-                                do.packOther(dg) # TODO Should we check for airecv?
-                                
-                                self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER, dg)
-                    
-                    # We announce to clients too (cause we're a ClientAgent)
-                    self.clientAgent.announceMove(do, prevParentId, prevZoneId, sender)
-                    
-                    
-                elif channel == 20100000:
-                    # Now we're in the case it was sent to the state server
-                    
-                    if code in (STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED_OTHER):
-                        # We are asked to create an object
-                        parentId = di.getUint32()
-                        zoneId = di.getUint32()
-                        classId = di.getUint16()
-                        doId = di.getUint32()
+                            self.messageDirector.sendMessage([prevParentChannel], sender, STATESERVER_OBJECT_LEAVING_AI_INTEREST, dg)
                         
-                        # We get the dclass
-                        dclass = self.dc.getClass(classId)
-                        
-                        # We create the object
-                        do = DistributedObject(doId, dclass, parentId, zoneId)
-                        do.senderId = sender
-                        
-                        # We save the object
-                        self.objects[doId] = do
-                        
-                        # We update the object
-                        do.receiveRequired(di)
-                        if code == STATESERVER_OBJECT_GENERATE_WITH_REQUIRED_OTHER:
-                            do.receiveOther(di)
-                            
-                        # We announce the object was created if it was not created by the owner.
                         channels = self.getInterested(do, sender)
-                        
                         if channels:
                             dg = Datagram()
                             dg.addUint32(do.parentId)
@@ -258,36 +404,87 @@ class StateServer:
                             do.packOther(dg) # TODO Should we check for airecv?
                             
                             self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER, dg)
-                            
-                        # We announce to clients too (cause we're a ClientAgent)
-                        self.clientAgent.announceCreate(do, sender)
+                
+                # We announce to clients too (cause we're a ClientAgent)
+                self.clientAgent.announceMove(do, prevParentId, prevZoneId, sender)
+                
+                
+            elif channel == 20100000:
+                # Now we're in the case it was sent to the state server
+                
+                if code in (STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED_OTHER):
+                    # We are asked to create an object
+                    parentId = di.getUint32()
+                    zoneId = di.getUint32()
+                    classId = di.getUint16()
+                    doId = di.getUint32()
+                    
+                    # We get the dclass
+                    dclass = self.dc.getClass(classId)
+                    
+                    # We create the object
+                    do = DistributedObject(doId, dclass, parentId, zoneId)
+                    do.senderId = sender
+                    
+                    # We save the object
+                    self.addObject(do)
+                    
+                    # We update the object
+                    do.receiveRequired(di)
+                    if code == STATESERVER_OBJECT_GENERATE_WITH_REQUIRED_OTHER:
+                        do.receiveOther(di)
                         
+                    # We announce the object was created if it was not created by the owner.
+                    channels = self.getInterested(do, sender)
+                    
+                    if channels:
+                        dg = Datagram()
+                        dg.addUint32(do.parentId)
+                        dg.addUint32(do.zoneId)
+                        dg.addUint16(do.dclass.getNumber())
+                        dg.addUint32(do.doId)
+                        do.packRequired(dg)
+                        do.packOther(dg) # TODO Should we check for airecv?
                         
-                    elif code == STATESERVER_SHARD_REST:
-                        # Shard is going down.
-                        # We gotta delete its objects.
-                        shardId = di.getUint64()
+                        self.messageDirector.sendMessage(channels, sender, STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER, dg)
                         
-                        # We get every object to delete,
-                        # which means we look for the objects created by this shard,
-                        # or every object parented to it.
-                        objects = []
-                        for do in self.objects.values():
-                            if do.senderId == shardId or (do.parentId in self.objects and self.objects[do.parentId].senderId == shardId):
-                                objects.append(do)
+                    # We announce to clients too (cause we're a ClientAgent)
+                    self.clientAgent.announceCreate(do, sender)
+                    
+                    
+                elif code == STATESERVER_SHARD_REST:
+                    # Shard is going down.
+                    # We gotta delete its objects.
+                    shardId = di.getUint64()
+                    
+                    # We get every object to delete
+                    objects = self.getShardObjects(shardId)
+                    
+                    # We got all the objects, we can now delete them.
+                    # The state server deletes the object, so we set the sender to 20100000.
+                    for do in objects.values():
+                        self.removeObject(do, 20100000)
                         
-                        # We got all the objects, we can now delete them.
-                        # The state server deletes the object, so we set the sender to 20100000.
-                        for do in objects:
-                            self.deleteObject(do, 20100000)
-                            
-                    else:
-                        raise NotImplementedError("Received %d on stateserver channel" % code)
+                    # Game clients get all their disables at once
+                    self.clientAgent.announceDeleteMany(objects.values(), 20100000)
                         
+                elif code == STATESERVER_QUERY_ZONE_OBJECT_ALL:
+                    # We are asked for every object in some zones
+                    context = di.getUint32()
+                    parentId = di.getUint32()
+                    zones = [di.getUint32() for n in range(di.getUint16())]
+                    
+                    # The answer is streamed, a few objects at a time
+                    locations = {(parentId, zoneId) for zoneId in zones}
+                    self.sendZoneObjects(sender, context, locations, self.getZoneObjects(parentId, zones), 0)
+                    
                 else:
-                    # If the unknown packet was sent on an object channel, we raise.  
-                    raise NotImplementedError("Received %d on object channel" % code)
-                
-                if di.getRemainingSize():
-                    raise Exception("Data remaining on stateserver: code %d has %d bytes left", (code, di.getRemainingBytes()))
-                
\ No newline at end of file
+                    raise NotImplementedError("Received %d on stateserver channel" % code)
+                    
+            else:
+                # If the unknown packet was sent on an object channel, we raise.  
+                raise NotImplementedError("Received %d on object channel" % code)
+            
+            if di.getRemainingSize():
+                raise Exception("Data remaining on stateserver: code %d has %d bytes left", (code, di.getRemainingBytes()))
+            
\ No newline at end of file
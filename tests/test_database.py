@@ -0,0 +1,51 @@
+"""
+Field updates of the objects loaded by the DatabaseServer are saved
+"""
+from panda3d.core import Datagram
+from panda3d.direct import DCPacker
+from database_object import DatabaseObject
+from py_otp import PyOTP
+from msgtypes import *
+
+import os
+
+
+def packField(field, *values):
+    packer = DCPacker()
+    packer.beginPack(field)
+    field.packArgs(packer, values)
+    packer.endPack()
+    return packer.getBytes()
+
+
+def loadSaved(db, doId):
+    with open(os.path.join(db.path, str(doId) + ".bin"), "rb") as file:
+        return DatabaseObject.fromBinary(db, file.read())
+
+
+def test_update_field_multiple_is_saved(tmp_path):
+    otp = PyOTP(listen=False)
+    db = otp.databaseServer
+    db.path = str(tmp_path)
+
+    # An avatar in use: the DatabaseServer gets its updates
+    doId = db.createDatabaseObject("DistributedToon").doId
+    do = db.loadDatabaseObject(doId)
+
+    # A db field, between two fields we don't keep
+    fields = (
+        (do.dclass.getFieldByName("setSmStop"), (0,)),
+        (do.dclass.getFieldByName("setMaxHp"), (40,)),
+        (do.dclass.getFieldByName("setSmStop"), (0,)),
+    )
+
+    dg = Datagram()
+    dg.addUint32(doId)
+    dg.addUint16(len(fields))
+    for field, values in fields:
+        dg.addUint16(field.getNumber())
+        dg.appendData(packField(field, *values))
+
+    otp.messageDirector.sendMessage([doId], 4000000, STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE, dg)
+
+    assert list(loadSaved(db, doId).fields["setMaxHp"]) == [40]
@@ -0,0 +1,144 @@
+"""
+Game client connections on the selectors loop (SocketTransport)
+"""
+from panda3d.core import Datagram
+from py_otp import PyOTP
+from msgtypes import *
+
+import selectors
+import socket
+import ssl
+import struct
+import time
+
+import pytest
+
+
+@pytest.fixture
+def otp():
+    """
+    A PyOTP with its ClientAgent listening on a free port
+    """
+    otp = PyOTP(listen=False)
+
+    agent = otp.clientAgent
+    agent.sslContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    agent.sslContext.load_cert_chain("server.cert", "server.key")
+
+    agent.sock = socket.socket()
+    agent.sock.bind(("127.0.0.1", 0))
+    agent.sock.listen(5)
+    otp.loop.register(agent.sock, selectors.EVENT_READ, otp.onAccept)
+
+    yield otp
+    agent.sock.close()
+
+
+def runLoop(otp, duration=0.1):
+    """
+    Run the loop for a while (a timer makes sure poll doesn't block forever)
+    """
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        otp.callLater(0.01, lambda: None)
+        otp.loop.poll()
+
+
+def connect(otp):
+    """
+    A game client connecting with TLS, handshaking while the loop is running
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+
+    sock = socket.create_connection(otp.clientAgent.sock.getsockname())
+    sock.setblocking(False)
+    sock = context.wrap_socket(sock, do_handshake_on_connect=False)
+
+    while True:
+        try:
+            sock.do_handshake()
+            break
+
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            runLoop(otp, 0.01)
+
+    runLoop(otp)
+    return sock
+
+
+def test_failed_handshakes(otp):
+    # Plaintext instead of TLS
+    sock = socket.create_connection(otp.clientAgent.sock.getsockname())
+    sock.sendall(b"GET / HTTP/1.0\r\n\r\n")
+    runLoop(otp)
+    sock.close()
+    runLoop(otp)
+
+    # A client going away in the middle of the handshake
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+
+    sock = socket.create_connection(otp.clientAgent.sock.getsockname())
+    sock.setblocking(False)
+    sock = context.wrap_socket(sock, do_handshake_on_connect=False)
+    with pytest.raises(ssl.SSLWantReadError):
+        sock.do_handshake()
+
+    runLoop(otp)
+    sock.close()
+    runLoop(otp)
+
+    assert otp.clientAgent.clients == []
+
+    # We're still accepting clients
+    sock = connect(otp)
+    assert len(otp.clientAgent.clients) == 1
+
+    sock.close()
+    runLoop(otp)
+    assert otp.clientAgent.clients == []
+
+
+def test_close_sends_everything(otp):
+    sock = connect(otp)
+    client = otp.clientAgent.clients[0]
+
+    # More than the socket takes at once, then the disconnect message
+    dg = Datagram()
+    dg.appendData(b"\0" * 50000)
+    for _ in range(100):
+        client.sendMessage(CLIENT_HEARTBEAT, dg)
+
+    client.disconnect(153)
+
+    data = b""
+    while True:
+        try:
+            received = sock.recv(1 << 16)
+
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            runLoop(otp, 0.01)
+            continue
+
+        except (ssl.SSLEOFError, ssl.SSLZeroReturnError):
+            break
+
+        if not received:
+            break
+
+        data += received
+
+    codes = []
+    offset = 0
+    while offset < len(data):
+        size, code = struct.unpack_from("<HH", data, offset)
+        codes.append(code)
+        offset += 2 + size
+
+    assert codes == [CLIENT_HEARTBEAT] * 100 + [CLIENT_GO_GET_LOST]
+
+    runLoop(otp)
+    assert otp.clientAgent.clients == []
@@ -0,0 +1,265 @@
+"""
+Objects sent to game clients as interests and objects change: a client is
+never sent an object twice, never disabled an object it doesn't have, and
+Client.knownObjects is what it can see through its interests.
+"""
+from panda3d.core import Datagram
+from panda3d.direct import DCPacker
+from client import Client
+from py_otp import PyOTP
+from msgtypes import *
+
+import random
+import struct
+
+import pytest
+
+
+DISTRICT = 200000000
+OTHER_DISTRICT = 200100000
+ZONES = range(2000, 2010)
+
+# Channels of the AIs generating the objects
+DISTRICT_AI = 4000001
+SUIT_AI = 4000000
+
+
+class ClientView:
+    """
+    Transport of a game client, keeping the objects the client was told about
+    """
+    def __init__(self):
+        self.client = None
+        self.objects = set()
+
+    def write(self, data):
+        offset = 0
+        while offset < len(data):
+            size, code = struct.unpack_from("<HH", data, offset)
+
+            if code == CLIENT_CREATE_OBJECT_REQUIRED_OTHER:
+                # The owner gets its avatar, but it's not one of the objects it sees
+                doId = struct.unpack_from("<I", data, offset + 14)[0]
+                if doId != self.client.avatarId:
+                    assert doId not in self.objects, "object %d created twice" % doId
+                    self.objects.add(doId)
+
+            elif code == CLIENT_OBJECT_DISABLE:
+                doId = struct.unpack_from("<I", data, offset + 4)[0]
+                assert doId in self.objects, "object %d disabled but never created" % doId
+                self.objects.remove(doId)
+
+            offset += 2 + size
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    def is_closing(self):
+        return False
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+
+def generate(otp, doId, dclassName, parentId, zoneId, sender=SUIT_AI):
+    """
+    STATESERVER_OBJECT_GENERATE_WITH_REQUIRED with default required fields
+    """
+    dclass = otp.dc.getClassByName(dclassName)
+
+    packer = DCPacker()
+    for index in range(dclass.getNumInheritedFields()):
+        field = dclass.getInheritedField(index)
+        if field.isRequired() and field.asAtomicField():
+            packer.beginPack(field)
+            packer.packDefaultValue()
+            packer.endPack()
+
+    dg = Datagram()
+    dg.addUint32(parentId)
+    dg.addUint32(zoneId)
+    dg.addUint16(dclass.getNumber())
+    dg.addUint32(doId)
+    dg.appendData(packer.getBytes())
+    otp.stateServer.handle(20100000, sender, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, dg)
+
+
+def delete(otp, doId, sender=SUIT_AI):
+    dg = Datagram()
+    dg.addUint32(doId)
+    otp.stateServer.handle(doId, sender, STATESERVER_OBJECT_DELETE_RAM, dg)
+
+
+def move(otp, doId, parentId, zoneId, sender=SUIT_AI):
+    dg = Datagram()
+    dg.addUint32(parentId)
+    dg.addUint32(zoneId)
+    otp.stateServer.handle(doId, sender, STATESERVER_OBJECT_SET_ZONE, dg)
+
+
+def shardRest(otp, shardId):
+    dg = Datagram()
+    dg.addUint64(shardId)
+    otp.stateServer.handle(20100000, shardId, STATESERVER_SHARD_REST, dg)
+
+
+def addInterest(client, handle, parentId, zones):
+    dg = Datagram()
+    dg.addUint16(CLIENT_ADD_INTEREST)
+    dg.addUint16(handle)
+    dg.addUint32(0)
+    dg.addUint32(parentId)
+    for zoneId in zones:
+        dg.addUint32(zoneId)
+
+    client.onDatagram(dg)
+
+
+def removeInterest(client, handle):
+    dg = Datagram()
+    dg.addUint16(CLIENT_REMOVE_INTEREST)
+    dg.addUint16(handle)
+    dg.addUint32(0)
+    client.onDatagram(dg)
+
+
+def addClient(otp, avatarId):
+    """
+    A game client playing the avatar avatarId (generated in the first zone)
+    """
+    generate(otp, avatarId, "DistributedToon", DISTRICT, ZONES[0], sender=avatarId)
+
+    view = ClientView()
+    client = Client(otp.clientAgent)
+    view.client = client
+    client.connection_made(view)
+    client.setAvatarId(avatarId)
+    return client
+
+
+def checkClients(otp):
+    """
+    Every client has exactly the objects in its interests
+    """
+    for client in otp.clientAgent.clients:
+        visible = set()
+        for parentId, zones in client.interests.values():
+            for do in otp.stateServer.objects.values():
+                if do.parentId == parentId and do.zoneId in zones:
+                    visible.add(do.doId)
+
+        visible.discard(client.avatarId)
+        assert client.knownObjects == visible
+        assert client.transport.objects == visible
+
+
+@pytest.fixture
+def otp():
+    """
+    Two districts with 10 suits in each of their zones
+    """
+    otp = PyOTP(listen=False)
+    for districtId in (DISTRICT, OTHER_DISTRICT):
+        generate(otp, districtId, "DistributedDistrict", 0, 0, sender=DISTRICT_AI)
+        for n in range(100):
+            generate(otp, districtId + 1 + n, "DistributedSuit", districtId, ZONES[n % 10])
+
+    return otp
+
+
+def test_add_replace_remove(otp):
+    client = addClient(otp, 310000000)
+
+    steps = (
+        lambda: addInterest(client, 1, DISTRICT, range(2000, 2005)),
+        lambda: addInterest(client, 2, DISTRICT, range(2003, 2008)),
+        lambda: addInterest(client, 2, DISTRICT, range(2005, 2010)),
+        lambda: addInterest(client, 2, OTHER_DISTRICT, range(2000, 2003)),
+        lambda: addInterest(client, 1, DISTRICT, ()),
+        lambda: removeInterest(client, 1),
+        lambda: addInterest(client, 1, OTHER_DISTRICT, range(2002, 2005)),
+        lambda: removeInterest(client, 2),
+        lambda: removeInterest(client, 1),
+    )
+
+    for step in steps:
+        step()
+        checkClients(otp)
+
+
+def test_moves(otp):
+    client = addClient(otp, 310000000)
+    addInterest(client, 1, DISTRICT, range(2000, 2005))
+    addInterest(client, 2, DISTRICT, range(2003, 2008))
+    checkClients(otp)
+
+    doId = DISTRICT + 1
+    for parentId, zoneId in ((DISTRICT, 2001), (DISTRICT, 2003), (DISTRICT, 2006), (DISTRICT, 2008),
+                             (DISTRICT, 2002), (OTHER_DISTRICT, 2000), (OTHER_DISTRICT, 2009), (DISTRICT, 2004)):
+        move(otp, doId, parentId, zoneId)
+        checkClients(otp)
+
+    # Our own avatar
+    for zoneId in (2003, 2009, 2000):
+        move(otp, client.avatarId, DISTRICT, zoneId, sender=client.avatarId)
+        checkClients(otp)
+
+
+def test_generate_delete(otp):
+    client = addClient(otp, 310000000)
+    addInterest(client, 1, DISTRICT, range(2000, 2005))
+    addInterest(client, 2, DISTRICT, range(2003, 2008))
+    checkClients(otp)
+
+    for n, zoneId in enumerate((2000, 2004, 2007, 2009)):
+        generate(otp, 300000000 + n, "DistributedSuit", DISTRICT, zoneId)
+        checkClients(otp)
+
+    for n in range(4):
+        delete(otp, 300000000 + n)
+        checkClients(otp)
+
+    shardRest(otp, SUIT_AI)
+    checkClients(otp)
+
+
+def test_random(otp):
+    rng = random.Random(25)
+    clients = [addClient(otp, 310000000 + n) for n in range(3)]
+    parents = (DISTRICT, OTHER_DISTRICT)
+    nextDoId = 300000000
+
+    for _ in range(500):
+        client = rng.choice(clients)
+        action = rng.randrange(6)
+
+        if action == 0:
+            zones = rng.sample(ZONES, rng.randrange(4))
+            addInterest(client, rng.randrange(3), rng.choice(parents), zones)
+
+        elif action == 1 and client.interests:
+            removeInterest(client, rng.choice(list(client.interests)))
+
+        elif action == 2:
+            generate(otp, nextDoId, "DistributedSuit", rng.choice(parents), rng.choice(ZONES))
+            nextDoId += 1
+
+        elif action in (3, 4):
+            suits = [doId for doId, do in otp.stateServer.objects.items() if do.senderId == SUIT_AI]
+            if action == 3:
+                delete(otp, rng.choice(suits))
+
+            else:
+                move(otp, rng.choice(suits), rng.choice(parents), rng.choice(ZONES))
+
+        else:
+            move(otp, client.avatarId, rng.choice(parents), rng.choice(ZONES), sender=client.avatarId)
+
+        checkClients(otp)
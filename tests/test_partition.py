@@ -0,0 +1,148 @@
+"""
+StateServer partitions: the owners of the objects of the other partitions
+are forgotten with the objects, and what's only for a partition stays on its MD
+"""
+from panda3d.core import Datagram
+from panda3d.direct import DCPacker
+from partition import MIRROR_CHANNEL, PARTITIONS_CHANNEL
+from py_otp import PyOTP
+from msgtypes import *
+
+
+# The district is in the first partition, its suits in the second one
+DISTRICT = 200000000
+SUIT = 300000001
+
+DISTRICT_AI = 4000001
+SUIT_AI = 4000000
+
+
+class Link:
+    """
+    Upstream connection of a partition MD, delivering to the other partition
+    """
+    def __init__(self):
+        self.other = None
+        self.messages = []
+
+    def sendMessage(self, message):
+        self.messages.append(message)
+        md = self.other.messageDirector
+        md.routeMessage(message, md.upstream)
+
+
+class Receiver:
+    def __init__(self):
+        self.codes = []
+
+    def handle(self, channel, sender, code, datagram):
+        self.codes.append(code)
+
+
+def makePartitions():
+    partitions = [PyOTP(listen=False, partition=(index, 2)) for index in range(2)]
+    links = [Link(), Link()]
+
+    for otp, link, other in zip(partitions, links, reversed(partitions)):
+        link.other = other
+        otp.messageDirector.upstream = link
+
+    return partitions, links
+
+
+def generate(otp, doId, dclassName, parentId, zoneId, sender):
+    dclass = otp.dc.getClassByName(dclassName)
+
+    packer = DCPacker()
+    for index in range(dclass.getNumInheritedFields()):
+        field = dclass.getInheritedField(index)
+        if field.isRequired() and field.asAtomicField():
+            packer.beginPack(field)
+            packer.packDefaultValue()
+            packer.endPack()
+
+    dg = Datagram()
+    dg.addUint32(parentId)
+    dg.addUint32(zoneId)
+    dg.addUint16(dclass.getNumber())
+    dg.addUint32(doId)
+    dg.appendData(packer.getBytes())
+    otp.messageDirector.sendMessage([20100000], sender, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, dg)
+
+
+def test_owners():
+    (first, second), links = makePartitions()
+
+    generate(first, DISTRICT, "DistributedDistrict", 0, 0, DISTRICT_AI)
+    generate(second, SUIT, "DistributedSuit", DISTRICT, 2000, SUIT_AI)
+
+    assert DISTRICT in first.stateServer.objects and SUIT in second.stateServer.objects
+    assert second.stateServer.owners == {DISTRICT: DISTRICT_AI}
+    assert first.stateServer.owners == {SUIT: SUIT_AI}
+
+    # The district AI hears about the suit
+    suit = second.stateServer.objects[SUIT]
+    assert second.stateServer.getInterested(suit, SUIT_AI) == [DISTRICT_AI]
+
+    # Once the district is deleted, the other partition forgets it
+    dg = Datagram()
+    dg.addUint32(DISTRICT)
+    first.messageDirector.sendMessage([DISTRICT], DISTRICT_AI, STATESERVER_OBJECT_DELETE_RAM, dg)
+
+    assert second.stateServer.owners == {} and second.stateServer.ownerObjects == {}
+    assert second.stateServer.getInterested(suit, SUIT_AI) == []
+
+    # A shard rest deletes the children of its objects in other partitions
+    generate(first, DISTRICT, "DistributedDistrict", 0, 0, DISTRICT_AI)
+
+    dg = Datagram()
+    dg.addUint64(DISTRICT_AI)
+    first.messageDirector.sendMessage([20100000], DISTRICT_AI, STATESERVER_SHARD_REST, dg)
+
+    for otp in (first, second):
+        assert DISTRICT not in otp.stateServer.objects and SUIT not in otp.stateServer.objects
+        assert otp.stateServer.owners == {} and otp.stateServer.ownerObjects == {}
+
+
+def test_local_traffic():
+    (first, second), links = makePartitions()
+
+    # The AIs are connected to the MD of the partition having the suit
+    receivers = {SUIT_AI: Receiver(), DISTRICT_AI: Receiver()}
+    for channel, receiver in receivers.items():
+        second.registerChannel(channel, receiver)
+
+    generate(first, DISTRICT, "DistributedDistrict", 0, 0, DISTRICT_AI)
+    generate(second, SUIT, "DistributedSuit", DISTRICT, 2000, SUIT_AI)
+    del links[1].messages[:]
+    for receiver in receivers.values():
+        del receiver.codes[:]
+
+    # A game client asking for a battle (clsend airecv)
+    field = second.dc.getClassByName("DistributedSuit").getFieldByName("requestBattle")
+    dg = Datagram()
+    dg.addUint32(SUIT)
+    dg.addUint16(field.getNumber())
+    dg.appendData(field.getDefaultValue())
+    second.messageDirector.sendMessage([SUIT], 10000001, STATESERVER_OBJECT_UPDATE_FIELD, dg)
+
+    assert all(receiver.codes == [STATESERVER_OBJECT_UPDATE_FIELD] for receiver in receivers.values())
+    assert links[1].messages == []
+
+    # What's for game clients still goes to the main process
+    dg = Datagram()
+    dg.addUint32(DISTRICT)
+    dg.addUint32(2001)
+    second.messageDirector.sendMessage([SUIT], SUIT_AI, STATESERVER_OBJECT_SET_ZONE, dg)
+
+    assert receivers[DISTRICT_AI].codes[-1] == STATESERVER_OBJECT_CHANGE_ZONE
+    assert [message.channels for message in links[1].messages] == [[MIRROR_CHANNEL]]
+
+    # Deletes go to the mirror and the other partitions
+    del links[1].messages[:]
+    dg = Datagram()
+    dg.addUint32(SUIT)
+    second.messageDirector.sendMessage([SUIT], SUIT_AI, STATESERVER_OBJECT_DELETE_RAM, dg)
+
+    assert [message.channels for message in links[1].messages] == [[MIRROR_CHANNEL, PARTITIONS_CHANNEL]]
+    assert first.stateServer.owners == {}
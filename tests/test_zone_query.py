@@ -0,0 +1,93 @@
+"""
+STATESERVER_QUERY_ZONE_OBJECT_ALL answers, streamed a batch at a time
+"""
+from panda3d.core import Datagram, DatagramIterator
+from panda3d.direct import DCPacker
+from py_otp import PyOTP
+from msgtypes import *
+
+
+DISTRICT = 200000000
+AI = 4000001
+
+
+def generate(otp, doId, dclassName, parentId, zoneId):
+    dclass = otp.dc.getClassByName(dclassName)
+
+    packer = DCPacker()
+    for index in range(dclass.getNumInheritedFields()):
+        field = dclass.getInheritedField(index)
+        if field.isRequired() and field.asAtomicField():
+            packer.beginPack(field)
+            packer.packDefaultValue()
+            packer.endPack()
+
+    dg = Datagram()
+    dg.addUint32(parentId)
+    dg.addUint32(zoneId)
+    dg.addUint16(dclass.getNumber())
+    dg.addUint32(doId)
+    dg.appendData(packer.getBytes())
+    otp.stateServer.handle(20100000, AI, STATESERVER_OBJECT_GENERATE_WITH_REQUIRED, dg)
+
+
+class Receiver:
+    """
+    The AI asking, keeping the (doId, parentId, zoneId) of the answers
+    """
+    def __init__(self):
+        self.objects = []
+        self.done = False
+
+    def handle(self, channel, sender, code, datagram):
+        if code == STATESERVER_OBJECT_ENTERZONE_WITH_REQUIRED_OTHER:
+            di = DatagramIterator(datagram)
+            parentId, zoneId, dclassId, doId = di.getUint32(), di.getUint32(), di.getUint16(), di.getUint32()
+            self.objects.append((doId, parentId, zoneId))
+
+        elif code == STATESERVER_QUERY_ZONE_OBJECT_ALL_DONE:
+            self.done = True
+
+
+def test_changes_between_batches():
+    otp = PyOTP(listen=False)
+    otp.stateServer.queryBatchSize = 2
+
+    # We run the batches ourselves
+    pending = []
+    otp.callLater = lambda delay, callback, *args: pending.append((callback, args))
+
+    generate(otp, DISTRICT, "DistributedDistrict", 0, 0)
+    for n in range(6):
+        generate(otp, 300000000 + n, "DistributedNPCToon", DISTRICT, 2000 + n % 2)
+
+    receiver = Receiver()
+    otp.registerChannel(AI, receiver)
+
+    dg = Datagram()
+    dg.addUint32(1)
+    dg.addUint32(DISTRICT)
+    dg.addUint16(2)
+    dg.addUint32(2000)
+    dg.addUint32(2001)
+    otp.stateServer.handle(20100000, AI, STATESERVER_QUERY_ZONE_OBJECT_ALL, dg)
+
+    sent = {doId for doId, parentId, zoneId in receiver.objects}
+    later = sorted({300000000 + n for n in range(6)} - sent)
+
+    # Before the next batches: one object is moved to another queried zone,
+    # one is moved away, one is deleted
+    stateServer = otp.stateServer
+    stateServer.moveObject(stateServer.objects[later[0]], DISTRICT, 2001)
+    stateServer.moveObject(stateServer.objects[later[1]], DISTRICT, 3000)
+    stateServer.removeObject(stateServer.objects[later[2]], AI)
+
+    while pending:
+        callback, args = pending.pop(0)
+        callback(*args)
+
+    assert receiver.done
+    doIds = [doId for doId, parentId, zoneId in receiver.objects]
+    assert later[0] in doIds and later[1] not in doIds and later[2] not in doIds
+    assert len(doIds) == len(set(doIds)) == 4
+    assert all(parentId == DISTRICT and zoneId in (2000, 2001) for doId, parentId, zoneId in receiver.objects)